@@ -0,0 +1,89 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+"""Benchmark of grouping the lines of an MTR file by order.
+
+Compares filtering the DataFrame for every order (the previous implementation, O(lines x
+orders)) against the single pass `iter_mtr_orders`, on a synthetic MTR file. The
+previous implementation is timed on a sample of orders and extrapolated.
+
+    bench execute amazon_sp_erpnext.amazon_sp_erpnext.benchmarks.mtr_benchmark.run \\
+        --kwargs "{'lines': 100000}"
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr import MTR_COLUMNS as mcols
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.sales_invoice_controller import (
+    iter_mtr_orders,
+)
+
+
+def make_mtr_df(lines=100000, lines_per_order=2, seed=0):
+    """Returns a synthetic B2C MTR DataFrame, with orders spread across the file."""
+    rng = np.random.default_rng(seed)
+    order_count = max(lines // lines_per_order, 1)
+    order_idx = rng.integers(0, order_count, size=lines)
+
+    return pd.DataFrame(
+        {
+            mcols.SELLER_GSTIN: "29AAACX0000X1ZX",
+            mcols.INVOICE_NUMBER: [f"IN-{idx}" for idx in order_idx],
+            mcols.INVOICE_DATE: "2022-11-01 10:15:00",
+            mcols.TRANSACTION_TYPE: "Shipment",
+            mcols.ORDER_ID: [
+                f"404-{idx:07}-{idx * 7 % 10000000:07}" for idx in order_idx
+            ],
+            mcols.ORDER_DATE: "2022-10-30 08:00:00",
+            mcols.QUANTITY: rng.integers(1, 4, size=lines),
+            mcols.HSN_SAC: "33049990",
+            mcols.SKU: [f"SKU-{idx % 500:03}" for idx in order_idx],
+            mcols.SHIP_TO_CITY: "BENGALURU",
+            mcols.SHIP_TO_STATE: rng.choice(
+                ["KARNATAKA", "DELHI", "MAHARASHTRA"], lines
+            ),
+            mcols.SHIP_TO_POSTAL_CODE: "560001",
+            mcols.TAX_EXCLUSIVE_GROSS: rng.uniform(100, 1000, size=lines).round(2),
+            mcols.SGST_RATE: 0.09,
+            mcols.IGST_RATE: 0.0,
+            mcols.WAREHOUSE_ID: rng.choice(["BLR7", "DEL4", "BOM5"], lines),
+        }
+    )
+
+
+def iter_mtr_orders_by_filter(df):
+    for order_id in set(df[mcols.ORDER_ID].values.tolist()):
+        yield order_id, df[df[mcols.ORDER_ID] == order_id].to_dict("records")
+
+
+def time_orders(orders, limit=None):
+    start, count = time.perf_counter(), 0
+    for _ in orders:
+        count += 1
+        if limit and count >= limit:
+            break
+    return count, time.perf_counter() - start
+
+
+def run(lines=100000, lines_per_order=2, sample_orders=200):
+    df = make_mtr_df(lines, lines_per_order)
+    order_count = df[mcols.ORDER_ID].nunique()
+
+    sampled, elapsed = time_orders(iter_mtr_orders_by_filter(df), limit=sample_orders)
+    before = elapsed / sampled * order_count
+
+    _, after = time_orders(iter_mtr_orders(df))
+
+    result = {
+        "lines": lines,
+        "orders": order_count,
+        "before_seconds": round(before, 2),
+        "before_extrapolated_from_orders": sampled,
+        "after_seconds": round(after, 2),
+        "speedup": round(before / after, 1),
+    }
+    print(result)
+    return result
@@ -0,0 +1,70 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+"""Micro-benchmark for SigV4 request signing.
+
+Compares signing throughput when the signing key is derived for every request (the
+previous behaviour) against the memoized signing key.
+
+    bench execute amazon_sp_erpnext.amazon_sp_erpnext.benchmarks.sigv4_benchmark.run
+"""
+
+import timeit
+
+from requests import Request
+
+import amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_api as sp_api
+
+
+def get_auth():
+    return sp_api.AWSSigV4(
+        service="execute-api",
+        aws_access_key_id="ASIABENCHMARKACCESSKEY",
+        aws_secret_access_key="benchmark/secret/access/key",
+        aws_session_token="benchmark-session-token",
+        region="eu-west-1",
+    )
+
+
+def get_prepared_request():
+    return Request(
+        method="GET",
+        url="https://sellingpartnerapi-eu.amazon.com/orders/v0/orders",
+        params={
+            "CreatedAfter": "2022-11-01T00:00:00",
+            "MarketplaceIds": "A21TJRUUN4KGV",
+            "MaxResultsPerPage": 50,
+        },
+        headers={"x-amz-access-token": "Atza|benchmark"},
+    ).prepare()
+
+
+def time_signing(auth, prepared_request, iterations):
+    return timeit.timeit(lambda: auth(prepared_request.copy()), number=iterations)
+
+
+def run(iterations=20000):
+    auth, prepared_request = get_auth(), get_prepared_request()
+    memoized_get_signing_key = sp_api.get_signing_key
+
+    try:
+        # derive the signing key for every request, as before memoization
+        sp_api.get_signing_key = memoized_get_signing_key.__wrapped__
+        before = time_signing(auth, prepared_request, iterations)
+    finally:
+        sp_api.get_signing_key = memoized_get_signing_key
+
+    after = time_signing(auth, prepared_request, iterations)
+
+    result = {
+        "iterations": iterations,
+        "before_per_sec": round(iterations / before),
+        "after_per_sec": round(iterations / after),
+        "speedup": round(before / after, 2),
+    }
+    print(result)
+    return result
+
+
+if __name__ == "__main__":
+    run()
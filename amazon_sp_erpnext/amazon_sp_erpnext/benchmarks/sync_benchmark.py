@@ -0,0 +1,107 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+"""Benchmark of the order sync against the local SP-API simulator.
+
+Measures orders per second of `AmazonRepositoryExtn._get_orders` (listing orders) and
+`AmazonRepository.get_orders` (listing orders, fetching items and charges and creating
+Sales Orders). Nothing is sent to Amazon and all documents are rolled back.
+
+    bench --site mysite execute \\
+        amazon_sp_erpnext.amazon_sp_erpnext.benchmarks.sync_benchmark.run \\
+        --kwargs "{'amz_setting_name': 'My Company', 'latency': 0.2}"
+
+Pass `fixture_path` to replay responses recorded with `RecordingAdapter` instead.
+"""
+
+import time
+
+import frappe
+
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_repository import (
+    AmazonRepository,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_repository_extn import (
+    AmazonRepositoryExtn,
+)
+from amazon_sp_erpnext.tests.amazon_sp_simulator import (
+    ReplayAdapter,
+    SPAPISimulator,
+    simulate,
+)
+
+CREATED_AFTER = "2022-11-01T00:00:00"
+
+
+def get_repository(repository_class, amz_setting_name):
+    repository = repository_class(amz_setting_name)
+    # separate LWA token, rate limit and circuit breaker cache keys from the real account
+    repository.instance_params.update(
+        client_id="sp-api-simulator", refresh_token="Atzr|sp-api-simulator"
+    )
+    return repository
+
+
+def time_orders(name, sync):
+    start = time.perf_counter()
+    try:
+        count = sync()
+        error = None
+    except Exception as e:
+        count, error = 0, repr(e)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "orders": count,
+        "seconds": round(elapsed, 2),
+        "orders_per_sec": round(count / elapsed, 2) if elapsed else 0,
+    }
+    if error:
+        result["error"] = error
+    print(name, result)
+    return result
+
+
+def run(
+    amz_setting_name,
+    order_count=500,
+    items_per_order=2,
+    latency=0.1,
+    throttle_rate=0,
+    fixture_path=None,
+):
+    if fixture_path:
+        adapter = ReplayAdapter(fixture_path, latency=latency)
+    else:
+        adapter = SPAPISimulator(
+            order_count=order_count,
+            items_per_order=items_per_order,
+            item_codes=frappe.get_all("Item", pluck="name", limit=100) or None,
+            latency=latency,
+            throttle_rate=throttle_rate,
+        )
+
+    results = {}
+    try:
+        with simulate(adapter):
+            results["AmazonRepositoryExtn._get_orders"] = time_orders(
+                "AmazonRepositoryExtn._get_orders",
+                lambda: sum(
+                    1
+                    for _ in get_repository(
+                        AmazonRepositoryExtn, amz_setting_name
+                    )._get_orders(CREATED_AFTER)
+                ),
+            )
+            results["AmazonRepository.get_orders"] = time_orders(
+                "AmazonRepository.get_orders",
+                lambda: len(
+                    get_repository(AmazonRepository, amz_setting_name).get_orders(
+                        CREATED_AFTER
+                    )
+                ),
+            )
+    finally:
+        frappe.db.rollback()
+
+    return results
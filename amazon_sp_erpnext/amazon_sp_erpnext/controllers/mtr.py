@@ -92,3 +92,42 @@ class MTR_COLUMNS(object):
     CUSTOMER_BILL_TO_GSTID = "Customer Bill To Gstid"
     CUSTOMER_SHIP_TO_GSTID = "Customer Ship To Gstid"
     BUYER_NAME = "Buyer Name"
+
+    # computed from INVOICE_DATE and ORDER_DATE when an MTR file is read
+    POSTING_DATE = "posting_date"
+    POSTING_TIME = "posting_time"
+    PO_DATE = "po_date"
+
+    # {column: (dtype, required)} of the columns read from MTR files
+    SCHEMA = {
+        SELLER_GSTIN: ("category", True),
+        INVOICE_DATE: (str, True),
+        TRANSACTION_TYPE: ("category", True),
+        ORDER_ID: (str, True),
+        ORDER_DATE: (str, False),
+        QUANTITY: ("float64", True),
+        HSN_SAC: (str, False),
+        SKU: (str, True),
+        SHIP_TO_CITY: ("category", False),
+        SHIP_TO_STATE: ("category", False),
+        SHIP_TO_POSTAL_CODE: (str, False),
+        TAX_EXCLUSIVE_GROSS: ("float64", True),
+        SGST_RATE: ("float64", False),
+        IGST_RATE: ("float64", False),
+        WAREHOUSE_ID: ("category", True),
+        CUSTOMER_BILL_TO_GSTID: (str, False),
+        BUYER_NAME: (str, False),
+        IRN_NUMBER: (str, False),
+    }
+
+
+def get_mtr_dtypes():
+    return {column: dtype for column, (dtype, _) in MTR_COLUMNS.SCHEMA.items()}
+
+
+def get_missing_mtr_columns(columns):
+    return [
+        column
+        for column, (_, required) in MTR_COLUMNS.SCHEMA.items()
+        if required and column not in columns
+    ]
@@ -0,0 +1,116 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import cstr, flt
+from erpnext.stock.get_item_details import get_item_tax_map
+
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr import MTR_COLUMNS as mcols
+
+
+def get_item_key(sku):
+    """Items are matched case-insensitively, like the database does."""
+    return cstr(sku).casefold()
+
+
+class MTRMasterData(object):
+    """Items, warehouses and item tax templates referenced by an MTR file.
+
+    `load` fetches the masters for all unique SKUs, fulfilment centers and (tax column,
+    rate) pairs of a DataFrame with one query per doctype. All lookups made while building
+    invoices are then served from memory."""
+
+    def __init__(self, company, amz_common) -> None:
+        self.company = company
+        self.amz_common = amz_common
+        self.items = {}
+        self.warehouses = {}
+        self.item_tax_templates = {}
+        self.item_tax_maps = {}
+        self.addresses = {}
+        self.new_addresses = []
+
+    def load(self, df):
+        skus = {
+            sku
+            for sku in df[mcols.SKU].dropna().unique()
+            if get_item_key(sku) not in self.items
+        }
+        if skus:
+            for d in frappe.get_all(
+                "Item",
+                filters={"name": ("in", list(skus))},
+                fields=["name", "item_code", "item_name", "description", "stock_uom"],
+            ):
+                self.items[get_item_key(d.name)] = d
+
+        fulfilment_centers = set(df[mcols.WAREHOUSE_ID].dropna()) - set(self.warehouses)
+        if fulfilment_centers:
+            for d in frappe.get_all(
+                "Warehouse",
+                filters={
+                    "amazon_fba_fulfilment_center": ("in", list(fulfilment_centers)),
+                    "company": self.company,
+                },
+                fields=["name", "amazon_fba_fulfilment_center"],
+                order_by="name",
+            ):
+                self.warehouses.setdefault(d.amazon_fba_fulfilment_center, d.name)
+
+        tax_rates = set()
+        for column in (mcols.SGST_RATE, mcols.IGST_RATE):
+            if column in df.columns:
+                tax_rates.update(flt(rate, 6) for rate in df[column].dropna() if rate)
+        if tax_rates:
+            for d in frappe.get_all(
+                "Item Tax Template",
+                filters={
+                    "amazon_mtr_tax_column_cf": ("in", ["In State", "Out State"]),
+                    "amazon_mtr_tax_rate_cf": ("in", list(tax_rates)),
+                },
+                fields=["name", "amazon_mtr_tax_column_cf", "amazon_mtr_tax_rate_cf"],
+                order_by="name",
+            ):
+                self.item_tax_templates.setdefault(
+                    (d.amazon_mtr_tax_column_cf, flt(d.amazon_mtr_tax_rate_cf, 6)),
+                    d.name,
+                )
+
+    def get_item(self, sku):
+        return self.items.get(get_item_key(sku))
+
+    def get_warehouse(self, fc_name):
+        return self.warehouses.get(fc_name)
+
+    def get_item_tax_template(self, order):
+        tax_column = self.amz_common.get_mtr_tax_column(order)
+        if tax_column:
+            return self.item_tax_templates.get((tax_column[0], flt(tax_column[1], 6)))
+
+    def get_item_tax_map(self, item_tax_template):
+        if item_tax_template not in self.item_tax_maps:
+            self.item_tax_maps[item_tax_template] = get_item_tax_map(
+                self.company, item_tax_template, as_json=True
+            )
+        return self.item_tax_maps[item_tax_template]
+
+    def get_address(self, key, get_address):
+        """Memoizes address lookups (place of supply, company and customer addresses),
+        which only depend on a few distinct values in a file."""
+        if key not in self.addresses:
+            self.addresses[key] = get_address()
+        return self.addresses[key]
+
+    def set_address(self, key, address):
+        """Sets an address created for an order. It is forgotten by `rollback_addresses`
+        if the order is rolled back."""
+        self.addresses[key] = address
+        self.new_addresses.append(key)
+
+    def release_addresses(self):
+        self.new_addresses = []
+
+    def rollback_addresses(self):
+        for key in self.new_addresses:
+            self.addresses.pop(key, None)
+        self.new_addresses = []
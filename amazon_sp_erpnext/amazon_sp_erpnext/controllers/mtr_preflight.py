@@ -0,0 +1,154 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+import frappe
+import numpy as np
+import pandas as pd
+
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr import MTR_COLUMNS as mcols
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr_master_data import (
+    MTRMasterData,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.sales_invoice_controller import (
+    get_company_address,
+    iter_mtr_chunks,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.utils import get_existing_values
+
+PREFLIGHT_SAMPLE_SIZE = 20
+
+
+class MTRPreflight(object):
+    """Checks the lines of an MTR file against the masters the invoices need, before any
+    document is created. Each check is a vectorized anti-join of a chunk against the
+    masters loaded in `MTRMasterData`."""
+
+    def __init__(self, amz_setting) -> None:
+        self.amz_setting = frappe.get_cached_doc("Amazon SP Settings", amz_setting)
+        self.master_data = MTRMasterData(
+            self.amz_setting.company, frappe.get_single("Amazon SP Common Settings")
+        )
+        self.order_ids = set()
+        self.line_count = 0
+        self.invoiced_order_ids = set()
+        self.errors = {}
+
+    def check(self, df):
+        self.master_data.load(df)
+        self.line_count += len(df)
+        self.order_ids.update(df[mcols.ORDER_ID])
+        self.invoiced_order_ids.update(
+            get_existing_values(
+                "Sales Invoice", "amazon_order_id_cf", df[mcols.ORDER_ID].unique()
+            )
+        )
+
+        self.add_error(
+            "Invalid Item Code",
+            df,
+            ~df[mcols.SKU].str.casefold().isin(list(self.master_data.items)),
+            mcols.SKU,
+        )
+        self.add_error(
+            "Warehouse not found for Fulfilment Center",
+            df,
+            ~df[mcols.WAREHOUSE_ID].isin(list(self.master_data.warehouses)),
+            mcols.WAREHOUSE_ID,
+        )
+        self.add_error(
+            "Invalid Invoice Date",
+            df,
+            df[mcols.POSTING_DATE].isna(),
+            mcols.INVOICE_DATE,
+        )
+
+        tax_keys = self.get_tax_keys(df)
+        self.add_error(
+            "Item Tax Template not found for Tax Column and Rate",
+            df,
+            tax_keys.notna()
+            & ~tax_keys.map(lambda key: key in self.master_data.item_tax_templates),
+            tax_keys,
+        )
+
+        seller_gstins = [
+            gstin
+            for gstin in df[mcols.SELLER_GSTIN].dropna().unique()
+            if self.master_data.get_address(
+                ("company", self.amz_setting.company, gstin[:2]),
+                lambda: get_company_address(self.amz_setting.company, gstin),
+            )
+        ]
+        self.add_error(
+            "Company Address not found for Seller GSTIN",
+            df,
+            ~df[mcols.SELLER_GSTIN].isin(seller_gstins),
+            mcols.SELLER_GSTIN,
+        )
+
+    def get_tax_keys(self, df):
+        """Returns the (Amazon MTR Tax Column, rate) of each line, as in
+        `AmazonSPCommonSettings.get_mtr_tax_column`."""
+        rates = {
+            column: (
+                pd.to_numeric(df[column], errors="coerce").fillna(0).round(6)
+                if column in df.columns
+                else pd.Series(0, index=df.index)
+            )
+            for column in (mcols.SGST_RATE, mcols.IGST_RATE)
+        }
+        in_state, out_state = rates[mcols.SGST_RATE] != 0, rates[mcols.IGST_RATE] != 0
+
+        tax_column = np.where(in_state, "In State", "Out State")
+        rate = np.where(in_state, rates[mcols.SGST_RATE], rates[mcols.IGST_RATE])
+        return pd.Series(
+            [(c, r) for c, r in zip(tax_column, rate)], index=df.index, dtype=object
+        ).where(in_state | out_state, None)
+
+    def add_error(self, reason, df, failing, values):
+        if not failing.any():
+            return
+
+        if isinstance(values, str):
+            values = df[values]
+
+        error = self.errors.setdefault(
+            reason, {"order_ids": set(), "lines": 0, "values": set()}
+        )
+        error["order_ids"].update(df.loc[failing, mcols.ORDER_ID])
+        error["lines"] += int(failing.sum())
+        error["values"].update(values[failing].astype(str))
+
+    def get_summary(self):
+        return {
+            "orders": len(self.order_ids),
+            "lines": self.line_count,
+            "already_invoiced": len(self.invoiced_order_ids),
+            "errors": {
+                reason: {
+                    "orders": len(d["order_ids"]),
+                    "lines": d["lines"],
+                    "values": sorted(d["values"])[:PREFLIGHT_SAMPLE_SIZE],
+                    "sample_order_ids": sorted(d["order_ids"])[:PREFLIGHT_SAMPLE_SIZE],
+                }
+                for reason, d in self.errors.items()
+            },
+        }
+
+
+@frappe.whitelist()
+def preflight_mtr_file(file_name=None, amz_setting=None):
+    """Returns a summary, per reason, of the orders and lines of an MTR file that cannot
+    be invoiced with the current master data."""
+    if not file_name or not amz_setting:
+        frappe.throw(
+            "File and Amazon SP Settings are required for the preflight check."
+        )
+
+    frappe.has_permission("Amazon SP Settings", "read", amz_setting, throw=True)
+    frappe.has_permission("File", "read", file_name, throw=True)
+
+    preflight = MTRPreflight(amz_setting)
+    for df in iter_mtr_chunks(file_name):
+        preflight.check(df)
+    return preflight.get_summary()
@@ -0,0 +1,146 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import add_to_date, get_datetime, now_datetime
+
+# longest data range Amazon accepts for a report, in days
+REPORT_MAX_WINDOW_DAYS = {
+    "GET_GST_MTR_B2B_CUSTOM": 30,
+    "GET_GST_MTR_B2C_CUSTOM": 30,
+    "GET_GST_STR_ADHOC": 30,
+}
+DEFAULT_REPORT_MAX_WINDOW_DAYS = 30
+# shortest window worth a report request, in minutes
+REPORT_MIN_WINDOW = 60
+# leave recent data out of a window until Amazon has settled it, in minutes
+REPORT_DATA_DELAY = 30
+# days to look back when an account has no reports and no After Date
+REPORT_DEFAULT_LOOKBACK_DAYS = 1
+# reports of an account and report type pending at the same time, e.g. in a backfill
+REPORT_MAX_IN_FLIGHT = 3
+# requests of a window that ended FATAL or CANCELLED before it is given up
+REPORT_MAX_ATTEMPTS = 3
+
+PENDING_STATUSES = ("IN_QUEUE", "IN_PROGRESS")
+FAILED_STATUSES = ("FATAL", "CANCELLED")
+
+
+def get_watermark(amazon_settings, report_type):
+    """Returns the end of the windows planned for the account and report type, or the
+    start for the first report. Failed windows are retried in place by
+    `get_failed_windows`, so they do not move the watermark back, and windows given up
+    are logged by `log_abandoned_window`."""
+    watermark = frappe.db.sql(
+        """
+    select
+        max(end_time)
+    from `tabAmazon On Demand Report`
+    where amazon_settings = %s and report_type = %s
+    """,
+        (amazon_settings, report_type),
+    )[0][0]
+
+    if watermark:
+        return get_datetime(watermark)
+
+    after_date = frappe.db.get_value(
+        "Amazon SP Settings", amazon_settings, "after_date"
+    )
+    if after_date:
+        return get_datetime(after_date)
+    return add_to_date(now_datetime(), days=-REPORT_DEFAULT_LOOKBACK_DAYS)
+
+
+def get_failed_windows(amazon_settings, report_type):
+    """Returns the (start, end) windows whose reports failed and were not requested
+    again successfully, and not more than REPORT_MAX_ATTEMPTS times."""
+    return frappe.db.sql(
+        """
+    select
+        start_time, end_time
+    from `tabAmazon On Demand Report`
+    where amazon_settings = %(amazon_settings)s and report_type = %(report_type)s
+    group by start_time, end_time
+    having sum(ifnull(status, '') in %(failed)s) = count(*) and count(*) < %(max_attempts)s
+    order by start_time
+    """,
+        {
+            "amazon_settings": amazon_settings,
+            "report_type": report_type,
+            "failed": FAILED_STATUSES,
+            "max_attempts": REPORT_MAX_ATTEMPTS,
+        },
+    )
+
+
+def log_abandoned_window(doc):
+    """Logs an error when the report of a window failed REPORT_MAX_ATTEMPTS times, as
+    the window is no longer requested and the watermark is past it. A report for the
+    window can be created by hand."""
+    if doc.status not in FAILED_STATUSES:
+        return
+
+    statuses = frappe.get_all(
+        "Amazon On Demand Report",
+        filters={
+            "amazon_settings": doc.amazon_settings,
+            "report_type": doc.report_type,
+            "start_time": doc.start_time,
+            "end_time": doc.end_time,
+        },
+        pluck="status",
+    )
+    if len(statuses) < REPORT_MAX_ATTEMPTS or any(
+        d not in FAILED_STATUSES for d in statuses
+    ):
+        return
+
+    frappe.log_error(
+        title="Report window given up for {}".format(doc.amazon_settings),
+        message="{} reports from {} to {} failed {} times, the last {}.".format(
+            doc.report_type, doc.start_time, doc.end_time, len(statuses), doc.name
+        ),
+        reference_doctype=doc.doctype,
+        reference_name=doc.name,
+    )
+
+
+def get_in_flight_count(amazon_settings, report_type):
+    return frappe.db.count(
+        "Amazon On Demand Report",
+        {
+            "amazon_settings": amazon_settings,
+            "report_type": report_type,
+            "status": ("in", PENDING_STATUSES),
+        },
+    )
+
+
+def plan_report_windows(amazon_settings, report_type):
+    """Returns the (start, end) windows to request for the account and report type.
+
+    Failed windows are requested again first. New windows are contiguous from the
+    watermark up to now, each at most the report type's maximum range, so there are no
+    gaps and the fewest requests. At most REPORT_MAX_IN_FLIGHT reports are pending at a
+    time; a long backfill continues in the next runs."""
+    slots = REPORT_MAX_IN_FLIGHT - get_in_flight_count(amazon_settings, report_type)
+    if slots <= 0:
+        return []
+
+    windows = list(get_failed_windows(amazon_settings, report_type))[:slots]
+
+    start = get_watermark(amazon_settings, report_type)
+    until = add_to_date(now_datetime(), minutes=-REPORT_DATA_DELAY)
+    max_window_days = REPORT_MAX_WINDOW_DAYS.get(
+        report_type, DEFAULT_REPORT_MAX_WINDOW_DAYS
+    )
+
+    while len(windows) < slots:
+        if add_to_date(start, minutes=REPORT_MIN_WINDOW) > until:
+            break
+        end = min(add_to_date(start, days=max_window_days), until)
+        windows.append((start, end))
+        start = end
+
+    return windows
@@ -4,24 +4,43 @@
 import frappe
 from frappe import _
 import pandas as pd
-import numpy as np
-import io, os, json
-import dateutil
 from frappe.model.naming import get_default_naming_series
-from frappe.utils import cstr
-from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr import MTR_COLUMNS as mcols
+from frappe.utils import cint, cstr, get_system_timezone
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr import (
+    MTR_COLUMNS as mcols,
+    get_missing_mtr_columns,
+    get_mtr_dtypes,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr_master_data import (
+    MTRMasterData,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.utils import (
+    CLAIM_DONE_EXPIRY,
+    Claims,
+    get_existing_values,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_order_log.amazon_order_log import (
+    AmazonOrderLogWriter,
+)
+import time
 import zipfile
-from frappe.utils.csvutils import read_csv_content
+import zlib
+from contextlib import contextmanager
 from erpnext.controllers.accounts_controller import (
     add_taxes_from_tax_template,
 )
-
-from erpnext.stock.get_item_details import get_item_tax_map
 from india_compliance.gst_india.constants import STATE_NUMBERS
 
-
-def amz_datetime_to_date(amz_date):
-    return dateutil.parser.parse(amz_date).strftime("%Y-%m-%d")
+MTR_CHUNK_SIZE = 10000
+MTR_COMMIT_BATCH_SIZE = 100
+MTR_ORDER_SAVEPOINT = "amazon_mtr_order"
+# claims of orders are committed or released with each batch, so they only outlive a
+# batch when the job was killed
+MTR_ORDER_CLAIM_EXPIRY = 30 * 60
+MTR_ORDER_CLAIM_RETRY_INTERVAL = 5
+# orders invoiced by other jobs after the lookup of existing invoices are only guarded
+# by their done claims, so the lookup is refreshed well before those expire
+MTR_EXISTING_ORDERS_MAX_AGE = CLAIM_DONE_EXPIRY / 2
 
 
 def get_state_name(state_name):
@@ -31,10 +50,6 @@ def get_state_name(state_name):
     return gst_state and gst_state[0]
 
 
-def amz_datetime_to_time(amz_date):
-    return dateutil.parser.parse(amz_date).strftime("%H-%M-%s")
-
-
 def get_naming_series(amz_setting):
     return amz_setting.sales_invoice_series or get_default_naming_series(
         "Sales Invoice"
@@ -47,29 +62,6 @@ def get_b2c_customer():
     )
 
 
-def get_warehouse(fc_name, company):
-    warehouse = frappe.db.get_all(
-        "Warehouse",
-        pluck="name",
-        filters={"amazon_fba_fulfilment_center": fc_name, "company": company},
-        limit=1,
-    )
-    return warehouse and warehouse[0][0] or None
-
-
-def get_zip_content(content, file_doc):
-    # read signature to check if zip file
-    hex_signature = " ".join(["{:02X}".format(byte) for byte in content[:4]])
-    if hex_signature in ["50 4B 03 04", "50 4B 05 06", "50 4B 07 07"]:
-        _file = "{}{}".format(
-            os.path.abspath(frappe.get_site_path()), file_doc.file_url
-        )
-        with zipfile.ZipFile(_file) as z:
-            for file in z.filelist:
-                content = z.read(file.filename)
-    return content
-
-
 def get_b2b_customer(order, amz_setting):
     customer = "{}-{}".format(
         order.get("Buyer Name"), order.get(mcols.CUSTOMER_BILL_TO_GSTID)
@@ -104,6 +96,23 @@ def get_customer_address(customer, ship_to_state):
         return d[0]
 
 
+def get_company_address(company, company_gstin):
+    company_address = None
+    for d in frappe.db.sql(
+        """
+    select 
+        ta.name
+    from `tabDynamic Link` tdl
+    inner join tabAddress ta on ta.name = tdl.parent 
+    where tdl.parenttype = 'Address' and tdl.link_doctype = 'Company' 
+    and tdl.link_name = %s and ta.gst_state_number = %s
+    """,
+        (company, company_gstin[:2]),
+    ):
+        company_address = d[0]
+    return company_address
+
+
 def make_address(customer, gstin, order):
     title = "{}-{}".format(customer, gstin)
     return frappe.get_doc(
@@ -121,10 +130,7 @@ def make_address(customer, gstin, order):
     ).insert()
 
 
-def get_mtr_df(file_name=None, amz_setting=None):
-    amz_setting = frappe.get_cached_doc("Amazon SP Settings", amz_setting)
-    is_b2b, df, items = False, None, []
-
+def get_mtr_file(file_name=None):
     if not file_name:
         for d in frappe.get_all(
             "File",
@@ -137,19 +143,155 @@ def get_mtr_df(file_name=None, amz_setting=None):
     if not file_name:
         frappe.throw("No MTR `file to process.")
 
-    file_doc = frappe.get_doc("File", file_name)
-    content = file_doc.get_content()
+    return frappe.get_doc("File", file_name)
 
-    if not isinstance(content, str):
-        content = get_zip_content(content, file_doc)
 
-    df = pd.read_csv(
-        io.StringIO(cstr(content)),  # sep="\t",
-    )
+@contextmanager
+def open_mtr_file(file_doc):
+    """Opens the MTR file, or the report in a zipped MTR file, for streaming."""
+    path = file_doc.get_full_path()
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            with z.open(z.filelist[-1]) as f:
+                yield f
+    else:
+        with open(path, "rb") as f:
+            yield f
+
+
+def get_mtr_lines(df):
+    df = df[(df[mcols.TRANSACTION_TYPE] == "Shipment") & (df[mcols.QUANTITY] > 0)]
+
+    df = df.copy()
+    set_mtr_dates(df)
+
+    # NaN to None, only for the columns with empty values
+    for column in df.columns[df.isna().any()]:
+        df[column] = df[column].astype(object).where(df[column].notna(), None)
+    return df
+
+
+def set_mtr_dates(df):
+    """Sets posting date, posting time and po date columns, in the system timezone, from
+    the invoice and order dates of the lines."""
+    timezone = get_system_timezone()
+
+    invoice_date = pd.to_datetime(
+        df[mcols.INVOICE_DATE], utc=True, errors="coerce"
+    ).dt.tz_convert(timezone)
+    df[mcols.POSTING_DATE] = invoice_date.dt.strftime("%Y-%m-%d")
+    df[mcols.POSTING_TIME] = invoice_date.dt.strftime("%H:%M:%S")
+
+    if mcols.ORDER_DATE in df.columns:
+        df[mcols.PO_DATE] = (
+            pd.to_datetime(df[mcols.ORDER_DATE], utc=True, errors="coerce")
+            .dt.tz_convert(timezone)
+            .dt.strftime("%Y-%m-%d")
+        )
+
 
-    df = df.replace({np.NAN: None})
-    # df = df[df[mcols.ORDER_ID] == ""]
-    return df[(df[mcols.TRANSACTION_TYPE] == "Shipment") & (df[mcols.QUANTITY] > 0)]
+def iter_mtr_chunks(file_name=None, chunk_size=None):
+    """Yields DataFrames of the shipment lines of an MTR file, parsed `chunk_size` rows
+    at a time so that memory stays bounded for any size of file. Only the columns in
+    `MTR_COLUMNS.SCHEMA` are parsed, with their declared dtypes.
+
+    All lines of an order are in the same chunk. The lines of the last order in a chunk
+    are carried over to the next chunk, and so are the lines of orders that are not
+    contiguous in the file until their last line is read."""
+    for lines, offset in _iter_mtr_chunks(file_name, chunk_size):
+        yield lines
+
+
+def get_split_orders(file_doc):
+    """Returns {order id: (first row, last row)} of the orders whose lines are not
+    contiguous in the MTR file. Only the order id column is read."""
+    first_rows, split_orders = {}, {}
+    previous, row = None, 0
+
+    with open_mtr_file(file_doc) as f:
+        for chunk in pd.read_csv(
+            f,
+            usecols=lambda column: column == mcols.ORDER_ID,
+            dtype={mcols.ORDER_ID: str},
+            chunksize=MTR_CHUNK_SIZE,
+        ):
+            if mcols.ORDER_ID not in chunk.columns:
+                return {}
+
+            for order_id in chunk[mcols.ORDER_ID]:
+                if isinstance(order_id, str) and order_id != previous:
+                    if order_id in first_rows:
+                        split_orders.setdefault(order_id, [first_rows[order_id], row])
+                    else:
+                        first_rows[order_id] = row
+                if order_id in split_orders:
+                    split_orders[order_id][1] = row
+                previous = order_id
+                row += 1
+
+    return {order_id: tuple(rows) for order_id, rows in split_orders.items()}
+
+
+def _iter_mtr_chunks(file_name=None, chunk_size=None, offset=0):
+    """Yields (lines, offset) for the chunks of an MTR file after the first `offset`
+    rows, where offset is the number of leading rows of the file whose orders are all
+    yielded. Processing can be resumed from that offset.
+
+    Orders whose lines are split across the file are found in a first pass over the
+    order ids. Their lines are held back until the last one is read, and the offset
+    does not move past a held back line. When resuming, split orders that started
+    before the offset were already yielded, so their later lines are skipped."""
+    file_doc = get_mtr_file(file_name)
+    split_orders = get_split_orders(file_doc)
+    last_rows = {order_id: rows[1] for order_id, rows in split_orders.items()}
+    yielded_order_ids = {
+        order_id for order_id, rows in split_orders.items() if rows[0] < offset
+    }
+
+    with open_mtr_file(file_doc) as f:
+        carry = None
+        # rows of the file read so far
+        read_count = offset
+        for chunk in pd.read_csv(
+            f,
+            usecols=lambda column: column in mcols.SCHEMA,
+            dtype=get_mtr_dtypes(),
+            # bind the start offset, the callable is evaluated while offset advances
+            skiprows=(lambda idx, skip=offset: 0 < idx <= skip) if offset else None,
+            chunksize=chunk_size or MTR_CHUNK_SIZE,
+        ):
+            if carry is None and (missing := get_missing_mtr_columns(chunk.columns)):
+                frappe.throw(
+                    "Columns missing in MTR file: {}".format(", ".join(missing))
+                )
+
+            # index the rows by their position in the file
+            chunk.index = pd.RangeIndex(read_count, read_count + len(chunk))
+            read_count += len(chunk)
+
+            if yielded_order_ids:
+                chunk = chunk[~chunk[mcols.ORDER_ID].isin(yielded_order_ids)]
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+            # resumed at the end of the file, pandas yields a single empty chunk
+            if not len(chunk):
+                continue
+
+            order_ids = chunk[mcols.ORDER_ID]
+            is_carried = order_ids == order_ids.iloc[-1]
+            if last_rows:
+                is_carried |= order_ids.map(last_rows) >= read_count
+
+            carry = chunk[is_carried]
+            if len(carry):
+                offset = int(carry.index.min())
+            else:
+                offset = read_count
+            if len(lines := get_mtr_lines(chunk[~is_carried])):
+                yield lines, offset
+
+        if carry is not None and len(lines := get_mtr_lines(carry)):
+            yield lines, read_count
 
 
 def get_b2b_details(order, args, amz_setting):
@@ -163,178 +305,357 @@ def get_b2b_details(order, args, amz_setting):
     )
 
 
-def get_b2c_details(order, args):
+def get_b2c_details(order, args, master_data):
     # set customer, customer address, shipping address
     args["customer"] = get_b2c_customer()
-    args["customer_address"] = get_customer_address(
-        args.get("customer"), order.get(mcols.SHIP_TO_STATE)
+    address_key = ("customer", args.get("customer"), order.get(mcols.SHIP_TO_STATE))
+    args["customer_address"] = master_data.get_address(
+        address_key,
+        lambda: get_customer_address(
+            args.get("customer"), order.get(mcols.SHIP_TO_STATE)
+        ),
     )
 
     if not args.get("customer_address"):
         address = make_address(args.get("customer"), args.get("company_gstin"), order)
+        master_data.set_address(address_key, address.name)
         args["customer_address"] = address.name
         args["shipping_address_name"] = address.name
 
 
-def process_mtr_file(file_name=None, amz_setting=None, submit=True):
-    df = get_mtr_df(file_name, amz_setting)
-    if not len(df):
-        frappe.throw("No Order lines to import in file.")
+def iter_mtr_orders(df):
+    """Yields (order_id, lines) for each order in the MTR DataFrame.
 
-    amz_setting = frappe.get_cached_doc("Amazon SP Settings", amz_setting)
-    amz_common = frappe.get_single("Amazon SP Common Settings")
+    Rows are converted to records once and grouped with a single pass over the
+    order id column, instead of filtering the whole DataFrame for every order."""
+    records = df.to_dict("records")
+    for order_id, positions in df.groupby(mcols.ORDER_ID, sort=False).indices.items():
+        yield order_id, [records[idx] for idx in positions]
 
-    is_b2b = mcols.CUSTOMER_BILL_TO_GSTID in df.columns
 
-    count, total = 0, len(df)
-    for order_id in set(df[mcols.ORDER_ID].values.tolist()):
-        print("\n\ncreating sales invoice: %s" % (order_id))
+def get_shard(order_id, shard_count):
+    return zlib.crc32(cstr(order_id).encode()) % shard_count
 
-        df_copy = df[df[mcols.ORDER_ID] == order_id]
-        if not len(df_copy):
-            return
 
-        lines = df_copy.to_dict("records")
-        try:
-            order = lines[0]
-            order_id = order.get(mcols.ORDER_ID)
-            # check for duplicate
-            if frappe.db.exists("Sales Invoice", {"amazon_order_id_cf": order_id}):
-                continue
+def filter_shard(df, shard, shard_count):
+    """Returns the lines of the orders in `shard`, of `shard_count` shards by order id."""
+    return df[df[mcols.ORDER_ID].map(lambda d: get_shard(d, shard_count)) == shard]
 
-            posting_date = amz_datetime_to_date(order.get(mcols.INVOICE_DATE))
-            warehouse = frappe.db.get_value(
-                "Warehouse",
-                {"amazon_fba_fulfilment_center": order.get(mcols.WAREHOUSE_ID)},
-            )
 
-            args = {
-                "doctype": "Sales Invoice",
-                "naming_series": get_naming_series(amz_setting),
-                "company": amz_setting.company,
-                "posting_date": posting_date,
-                "posting_time": amz_datetime_to_time(order.get(mcols.INVOICE_DATE)),
-                "amazon_order_id_cf": order_id,
-                "debit_to": amz_setting.default_receivable_account,
-                "company_tax_id": order.get(mcols.SELLER_GSTIN),
-                "due_date": posting_date,  # order already paid and shipped in amazon
-                "cost_center": amz_setting.default_cost_center,
-                "po_no": order.get(mcols.ORDER_ID),
-                "po_date": order.get(mcols.ORDER_DATE),
-                "territory": amz_setting.territory,
-                "company_gstin": order.get(mcols.SELLER_GSTIN),
-                "port_of_loading": "",
-                "set_warehouse": warehouse,
-                "total_qty": sum([d.get(mcols.QUANTITY) for d in lines]),
-                "tax_category": amz_common.get_tax_category(order),
-                "gst_category": amz_common.get_gst_category(order),
-                "irn": order.get("IRN_NUMBER"),
-                "items": [],
-                # "contact_person": contact_name,
-                # "return_against":None,
-            }
-
-            if is_b2b:
-                get_b2b_details(order, args, amz_setting)
-            else:
-                get_b2c_details(order, args)
+def get_shard_order_counts(file_name, shard_count):
+    """Returns {shard: number of orders} of an MTR file split into `shard_count` shards."""
+    order_counts = {}
+    for df in iter_mtr_chunks(file_name):
+        for shard, count in (
+            df[mcols.ORDER_ID]
+            .drop_duplicates()
+            .map(lambda d: get_shard(d, shard_count))
+            .value_counts()
+            .items()
+        ):
+            order_counts[shard] = order_counts.get(shard, 0) + int(count)
+    return order_counts
+
+
+def process_mtr_file(
+    file_name=None,
+    amz_setting=None,
+    submit=True,
+    shard=None,
+    shard_count=None,
+    checkpoint=None,
+):
+    """Creates Sales Invoices for the orders of an MTR file. With `shard_count`, only the
+    orders of `shard` are processed, so that a file can be split across jobs.
+
+    With a `checkpoint`, processing resumes from its offset and stops when its time
+    budget is spent. Returns False if the file was not processed to the end."""
+    return MTRFileProcessor(amz_setting, submit, checkpoint).process(
+        file_name, shard, shard_count
+    )
 
-            # set address for india_compliance validation
-            args["place_of_supply"] = frappe.db.get_value(
-                "Address",
-                {"gst_state": mcols.SHIP_TO_STATE},
-                fieldname="gst_state_number",
-            )
 
-            # company_address From Address doctype : Based on Seller GSTIN
-            for dr in frappe.db.sql(
-                """
-            select 
-                ta.name
-            from `tabDynamic Link` tdl
-            inner join tabAddress ta on ta.name = tdl.parent 
-            where tdl.parenttype = 'Address' and tdl.link_doctype = 'Company' 
-            and tdl.link_name = %s and ta.gst_state_number = %s
-            """,
-                (args.get("company"), args.get("company_gstin")[:2]),
-            ):
-                args["company_address"] = dr[0]
-
-            sales_invoice = frappe.get_doc(args)
-
-            for d in lines:
-                if not d.get(mcols.QUANTITY):
+class MTRFileProcessor(object):
+    """Invoices the orders of an MTR file chunk by chunk.
+
+    Each order is invoiced within a savepoint, so a failing order only rolls back
+    itself, and invoices are committed every `mtr_commit_batch_size` orders (Amazon SP
+    Common Settings) along with the order logs and the checkpoint."""
+
+    def __init__(self, amz_setting, submit=True, checkpoint=None) -> None:
+        self.amz_setting = frappe.get_cached_doc("Amazon SP Settings", amz_setting)
+        self.amz_common = frappe.get_single("Amazon SP Common Settings")
+        self.master_data = MTRMasterData(self.amz_setting.company, self.amz_common)
+        self.claims = Claims(
+            "amazon_sp_erpnext:mtr_order", expiry=MTR_ORDER_CLAIM_EXPIRY
+        )
+        self.log_writer = AmazonOrderLogWriter()
+        self.submit = submit
+        self.checkpoint = checkpoint
+        self.commit_batch_size = (
+            cint(self.amz_common.mtr_commit_batch_size) or MTR_COMMIT_BATCH_SIZE
+        )
+        self.uncommitted_count = 0
+        self.order_ids = []
+        self.existing_order_ids = set()
+        self.existing_loaded_at = 0
+
+    def process(self, file_name=None, shard=None, shard_count=None):
+        offset = self.checkpoint.offset if self.checkpoint else 0
+        line_count = 0
+
+        try:
+            for df, end_offset in _iter_mtr_chunks(file_name, offset=offset):
+                if shard_count:
+                    df = filter_shard(df, shard, shard_count)
+                line_count += len(df)
+
+                if not self.process_lines(df):
+                    self.commit()
+                    return False
+
+                if self.checkpoint:
+                    self.checkpoint.set_offset(end_offset)
+            self.commit()
+        except Exception:
+            # uncommitted invoices of the claimed orders are rolled back with the job
+            self.claims.release_all()
+            raise
+
+        if not line_count and not shard_count and not offset:
+            frappe.throw("No Order lines to import in file.")
+
+        return True
+
+    def process_lines(self, df):
+        """Invoices the orders in `df`. Returns False if the time budget of the
+        checkpoint was spent before all orders were processed, in which case the
+        checkpoint is not moved past the chunk."""
+        if not len(df):
+            return True
+
+        is_b2b = mcols.CUSTOMER_BILL_TO_GSTID in df.columns
+
+        self.master_data.load(df)
+
+        # orders already invoiced, e.g. resent by overlapping report windows
+        self.order_ids = df[mcols.ORDER_ID].unique()
+        self.load_existing_order_ids()
+
+        for order_id, lines in iter_mtr_orders(df):
+            if time.monotonic() - self.existing_loaded_at > MTR_EXISTING_ORDERS_MAX_AGE:
+                self.load_existing_order_ids()
+            if order_id in self.existing_order_ids:
+                continue
+
+            if self.checkpoint:
+                if self.checkpoint.is_processed(order_id):
                     continue
+                if self.checkpoint.is_expired():
+                    return False
 
-                item_details = frappe.db.get_value(
-                    "Item",
-                    d.get(mcols.SKU),
-                    ["item_code", "item_name", "description", "stock_uom"],
-                    as_dict=True,
-                )
+            if (is_claimed := self.claim_order(order_id)) is None:
+                return False
+            if not is_claimed:
+                continue
 
-                if not item_details:
-                    frappe.throw(
-                        "Invalid Item Code: {} in Order Id: {}".format(
-                            d.get(mcols.SKU), order_id
-                        )
-                    )
-
-                sales_invoice.append(
-                    "items",
-                    {
-                        "item_code": item_details.item_code,
-                        "item_name": item_details.item_name,
-                        "description": item_details.description,
-                        "gst_hsn_code": d.get(mcols.HSN_SAC),
-                        "rate": d.get(mcols.TAX_EXCLUSIVE_GROSS),
-                        "net_rate": d.get(mcols.TAX_EXCLUSIVE_GROSS),
-                        "qty": d.get(mcols.QUANTITY) or 0,
-                        "delivered_qty": d.get(mcols.QUANTITY) or 0,
-                        "stock_uom": item_details.stock_uom,
-                        "conversion_factor": "1.0",
-                        "warehouse": get_warehouse(
-                            d.get(mcols.WAREHOUSE_ID), amz_setting.company
-                        ),
-                        "item_tax_template": amz_common.get_item_tax_template(order),
-                    },
-                )
+            self.process_order(order_id, lines, is_b2b)
 
-            for d in sales_invoice.items:
-                d.item_tax_rate = get_item_tax_map(
-                    sales_invoice.get("company"), d.item_tax_template, as_json=True
-                )
-                add_taxes_from_tax_template(d, sales_invoice, False)
+            self.uncommitted_count += 1
+            if self.uncommitted_count >= self.commit_batch_size:
+                self.commit()
 
-            sales_invoice.insert(ignore_permissions=True)
+        return True
 
-            if submit:
+    def load_existing_order_ids(self):
+        # committed first, so that the lookup sees the invoices committed by other
+        # jobs until now rather than at the start of the transaction
+        self.commit()
+        self.existing_order_ids = get_existing_values(
+            "Sales Invoice", "amazon_order_id_cf", self.order_ids
+        )
+        self.existing_loaded_at = time.monotonic()
+
+    def claim_order(self, order_id):
+        """Claims the order for this job. While another job is invoicing it, the batch
+        is committed, so that jobs never wait on each other, and the claim is retried
+        until the other job commits or its claim expires. Orders invoiced before are
+        skipped by the lookup of existing invoices, so the claim only guards against
+        concurrent jobs.
+
+        Returns False if another job invoiced the order, or None if the time budget of
+        the checkpoint was spent while waiting, so that the order is not skipped."""
+        while not self.claims.claim(order_id):
+            if self.claims.is_done(order_id):
+                return False
+            self.commit()
+            if self.checkpoint and self.checkpoint.is_expired():
+                return None
+            time.sleep(MTR_ORDER_CLAIM_RETRY_INTERVAL)
+        return True
+
+    def process_order(self, order_id, lines, is_b2b):
+        frappe.db.savepoint(MTR_ORDER_SAVEPOINT)
+        try:
+            sales_invoice = make_sales_invoice(
+                order_id,
+                lines,
+                self.amz_setting,
+                self.amz_common,
+                is_b2b,
+                self.master_data,
+            )
+
+            if self.submit:
                 sales_invoice.submit()
 
-            make_log(lines, order_id, sales_invoice.name)
-            print("Created invoice: ", sales_invoice.name)
-            # break
+            self.master_data.release_addresses()
+            make_log(self.log_writer, lines, order_id, sales_invoice.name)
+            frappe.logger("amazon_sp_erpnext").debug(
+                "Created invoice %s for order %s", sales_invoice.name, order_id
+            )
+            failed = False
         except Exception as e:
-            make_log(lines, order_id, sales_invoice=None, error=cstr(e))
+            frappe.db.rollback(save_point=MTR_ORDER_SAVEPOINT)
+            # addresses created for the order are rolled back too
+            self.master_data.rollback_addresses()
+            self.claims.release(order_id)
+            make_log(
+                self.log_writer, lines, order_id, sales_invoice=None, error=cstr(e)
+            )
             frappe.log_error(
                 title="Error creating invoice for %s" % order_id,
                 message=frappe.get_traceback(),
             )
-            print(e)
+            failed = True
+
+        if self.checkpoint:
+            self.checkpoint.add_order(order_id, failed=failed)
+
+    def commit(self):
+        if self.checkpoint:
+            self.checkpoint.save()
+        self.log_writer.flush()
+        frappe.db.commit()
+        self.claims.complete_all()
+        self.uncommitted_count = 0
+
+
+def make_sales_invoice(order_id, lines, amz_setting, amz_common, is_b2b, master_data):
+    """Builds and inserts the Sales Invoice for the lines of an MTR order. Masters are
+    looked up in `master_data`, loaded once for the file."""
+    order = lines[0]
+
+    posting_date = order.get(mcols.POSTING_DATE)
+    if not posting_date:
+        frappe.throw(
+            "Invalid Invoice Date: {} in Order Id: {}".format(
+                order.get(mcols.INVOICE_DATE), order_id
+            )
+        )
+
+    warehouse = master_data.get_warehouse(order.get(mcols.WAREHOUSE_ID))
+
+    args = {
+        "doctype": "Sales Invoice",
+        "naming_series": get_naming_series(amz_setting),
+        "company": amz_setting.company,
+        "posting_date": posting_date,
+        "posting_time": order.get(mcols.POSTING_TIME),
+        "amazon_order_id_cf": order_id,
+        "debit_to": amz_setting.default_receivable_account,
+        "company_tax_id": order.get(mcols.SELLER_GSTIN),
+        "due_date": posting_date,  # order already paid and shipped in amazon
+        "cost_center": amz_setting.default_cost_center,
+        "po_no": order.get(mcols.ORDER_ID),
+        "po_date": order.get(mcols.PO_DATE),
+        "territory": amz_setting.territory,
+        "company_gstin": order.get(mcols.SELLER_GSTIN),
+        "port_of_loading": "",
+        "set_warehouse": warehouse,
+        "total_qty": sum([d.get(mcols.QUANTITY) for d in lines]),
+        "tax_category": amz_common.get_tax_category(order),
+        "gst_category": amz_common.get_gst_category(order),
+        "irn": order.get(mcols.IRN_NUMBER),
+        "items": [],
+        # "contact_person": contact_name,
+        # "return_against":None,
+    }
+
+    if is_b2b:
+        get_b2b_details(order, args, amz_setting)
+    else:
+        get_b2c_details(order, args, master_data)
+
+    # set address for india_compliance validation
+    ship_to_state = get_state_name(order.get(mcols.SHIP_TO_STATE) or "") or None
+    args["place_of_supply"] = ship_to_state and master_data.get_address(
+        ("place_of_supply", ship_to_state),
+        lambda: frappe.db.get_value(
+            "Address",
+            {"gst_state": ship_to_state},
+            fieldname="gst_state_number",
+        ),
+    )
+
+    # company_address From Address doctype : Based on Seller GSTIN
+    company_address = master_data.get_address(
+        ("company", args.get("company"), args.get("company_gstin")[:2]),
+        lambda: get_company_address(args.get("company"), args.get("company_gstin")),
+    )
+    if company_address:
+        args["company_address"] = company_address
 
+    sales_invoice = frappe.get_doc(args)
 
-def make_log(order_lines, order_id, sales_invoice=None, error=None):
-    for d in order_lines:
-        frappe.get_doc(
+    for d in lines:
+        if not d.get(mcols.QUANTITY):
+            continue
+
+        item_details = master_data.get_item(d.get(mcols.SKU))
+
+        if not item_details:
+            frappe.throw(
+                "Invalid Item Code: {} in Order Id: {}".format(
+                    d.get(mcols.SKU), order_id
+                )
+            )
+
+        sales_invoice.append(
+            "items",
             {
-                "doctype": "Amazon Order Log",
-                "amazon_order_id": order_id,
-                "status": error and "Error" or "Processed",
-                "sales_invoice": sales_invoice,
-                "error": error,
-                "amazon_order_json": json.dumps(d),
-            }
-        ).insert()
+                "item_code": item_details.item_code,
+                "item_name": item_details.item_name,
+                "description": item_details.description,
+                "gst_hsn_code": d.get(mcols.HSN_SAC),
+                "rate": d.get(mcols.TAX_EXCLUSIVE_GROSS),
+                "net_rate": d.get(mcols.TAX_EXCLUSIVE_GROSS),
+                "qty": d.get(mcols.QUANTITY) or 0,
+                "delivered_qty": d.get(mcols.QUANTITY) or 0,
+                "stock_uom": item_details.stock_uom,
+                "conversion_factor": "1.0",
+                "warehouse": master_data.get_warehouse(d.get(mcols.WAREHOUSE_ID)),
+                "item_tax_template": master_data.get_item_tax_template(order),
+            },
+        )
+
+    for d in sales_invoice.items:
+        d.item_tax_rate = master_data.get_item_tax_map(d.item_tax_template)
+        add_taxes_from_tax_template(d, sales_invoice, False)
+
+    sales_invoice.insert(ignore_permissions=True)
+    return sales_invoice
+
+
+def make_log(log_writer, order_lines, order_id, sales_invoice=None, error=None):
+    # one log row per order, with its lines as a json array
+    log_writer.append(
+        order_id,
+        order_lines,
+        status=error and "Error" or "Processed",
+        sales_invoice=sales_invoice,
+        error=error,
+    )
 
 
 # def make_contacts(data):
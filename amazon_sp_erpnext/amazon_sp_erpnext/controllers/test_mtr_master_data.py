@@ -0,0 +1,30 @@
+# Copyright (c) 2022, Greycube and Contributors
+# See license.txt
+
+import frappe
+import pandas as pd
+from erpnext.stock.doctype.item.test_item import make_item
+from frappe.tests.utils import FrappeTestCase
+
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr import MTR_COLUMNS as mcols
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr_master_data import (
+    MTRMasterData,
+)
+
+
+class TestMTRMasterData(FrappeTestCase):
+    def test_items_match_case_insensitively(self):
+        item = make_item("_Test Amazon Sku-Mixed Case")
+        master_data = MTRMasterData("_Test Company", frappe._dict())
+        master_data.load(
+            pd.DataFrame(
+                {
+                    mcols.SKU: [item.name.upper(), item.name.lower()],
+                    mcols.WAREHOUSE_ID: [None, None],
+                }
+            )
+        )
+
+        self.assertEqual(master_data.get_item(item.name.upper()).name, item.name)
+        self.assertEqual(master_data.get_item(item.name.lower()).name, item.name)
+        self.assertEqual(master_data.get_item(item.name).name, item.name)
@@ -0,0 +1,203 @@
+# Copyright (c) 2022, Greycube and Contributors
+# See license.txt
+
+import csv
+import io
+from unittest.mock import patch
+
+import frappe
+import pandas as pd
+from frappe.tests.utils import FrappeTestCase
+
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr import MTR_COLUMNS as mcols
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.sales_invoice_controller import (
+    MTRFileProcessor,
+    _iter_mtr_chunks,
+    iter_mtr_chunks,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_on_demand_report_shard.amazon_on_demand_report_shard import (
+    MTRShardCheckpoint,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.test_amazon_sp_settings import (
+    make_amazon_sp_settings,
+)
+
+MTR_CHUNK_SIZE = "amazon_sp_erpnext.amazon_sp_erpnext.controllers.sales_invoice_controller.MTR_CHUNK_SIZE"
+
+# columns of an MTR line, other than the order id
+MTR_LINE = {
+    mcols.SELLER_GSTIN: "29AAACT0000A1Z5",
+    mcols.INVOICE_DATE: "2022-11-01T10:15:00+0000",
+    mcols.TRANSACTION_TYPE: "Shipment",
+    mcols.QUANTITY: 1,
+    mcols.SKU: "_Test Amazon Item",
+    mcols.TAX_EXCLUSIVE_GROSS: 499,
+    mcols.WAREHOUSE_ID: "BLR8",
+}
+
+
+def make_mtr_file(lines):
+    """Returns the File of an MTR report of `lines`, dicts of the columns of each line
+    that differ from MTR_LINE."""
+    columns = list(
+        dict.fromkeys([mcols.ORDER_ID, *MTR_LINE, *(c for d in lines for c in d)])
+    )
+
+    content = io.StringIO()
+    writer = csv.DictWriter(content, fieldnames=columns, restval="")
+    writer.writeheader()
+    for d in lines:
+        writer.writerow({**MTR_LINE, **d})
+
+    return frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_name": f"GST_MTR_B2C_{frappe.generate_hash(length=8)}.csv",
+            "content": content.getvalue(),
+            "is_private": 1,
+        }
+    ).insert(ignore_permissions=True)
+
+
+def get_line_counts(chunks):
+    """Returns {order id: number of lines} of the chunks, checking that each order is in
+    a single chunk."""
+    line_counts = {}
+    for lines in chunks:
+        for order_id, count in lines[mcols.ORDER_ID].value_counts().items():
+            if order_id in line_counts:
+                raise AssertionError(f"Order {order_id} is in more than one chunk")
+            line_counts[order_id] = count
+    return line_counts
+
+
+class MemoryCheckpoint(MTRShardCheckpoint):
+    """Checkpoint kept in memory, whose budget is spent after `order_budget` orders."""
+
+    def __init__(self, order_budget, offset=0, processed_order_ids=None) -> None:
+        self.order_budget = order_budget
+        self.offset = offset
+        self.processed_count = 0
+        self.failed_count = 0
+        self.processed_order_ids = set(processed_order_ids or [])
+
+    def is_expired(self) -> bool:
+        return self.processed_count + self.failed_count >= self.order_budget
+
+    def save(self) -> None:
+        pass
+
+
+class TestSalesInvoiceController(FrappeTestCase):
+    def make_mtr_file(self, lines):
+        file_doc = make_mtr_file(lines)
+        self.addCleanup(file_doc.delete, ignore_permissions=True)
+        return file_doc
+
+    def get_order_ids(self, count):
+        # claims of processed orders outlive the test, so ids are not reused across runs
+        prefix = frappe.generate_hash(length=8)
+        return [f"{prefix}-{idx:03}" for idx in range(count)]
+
+    def test_mtr_schema_columns(self):
+        order_ids = self.get_order_ids(2)
+        file_doc = self.make_mtr_file(
+            [
+                {mcols.ORDER_ID: order_ids[0], mcols.IRN_NUMBER: "IRN-0001"},
+                {mcols.ORDER_ID: order_ids[1], mcols.IRN_NUMBER: ""},
+            ]
+        )
+
+        lines = pd.concat(list(iter_mtr_chunks(file_doc.name)), ignore_index=True)
+        self.assertEqual(list(lines[mcols.ORDER_ID]), order_ids)
+        self.assertEqual(list(lines[mcols.IRN_NUMBER]), ["IRN-0001", None])
+
+    def test_mtr_chunks_resume(self):
+        order_ids = self.get_order_ids(6)
+        mtr_lines = [
+            {mcols.ORDER_ID: order_id} for order_id in order_ids for _ in range(2)
+        ]
+        mtr_lines.insert(
+            3, {mcols.ORDER_ID: order_ids[1], mcols.TRANSACTION_TYPE: "Refund"}
+        )
+        file_doc = self.make_mtr_file(mtr_lines)
+
+        chunks = [
+            (list(lines[mcols.ORDER_ID].unique()), offset)
+            for lines, offset in _iter_mtr_chunks(file_doc.name, chunk_size=3)
+        ]
+        self.assertEqual([d for ids, _ in chunks for d in ids], order_ids)
+        self.assertEqual(chunks[-1][1], len(mtr_lines))
+
+        # resuming from the offset of a chunk yields the orders after it
+        for idx, (_, offset) in enumerate(chunks):
+            resumed = [
+                d
+                for lines, _ in _iter_mtr_chunks(
+                    file_doc.name, chunk_size=3, offset=offset
+                )
+                for d in lines[mcols.ORDER_ID].unique()
+            ]
+            self.assertEqual(resumed, [d for ids, _ in chunks[idx + 1 :] for d in ids])
+
+    def test_mtr_chunks_split_orders(self):
+        order_ids = self.get_order_ids(5)
+        # the lines of the first two orders are not contiguous
+        rows = [0, 1, 0, 2, 3, 1, 4]
+        file_doc = self.make_mtr_file([{mcols.ORDER_ID: order_ids[d]} for d in rows])
+        line_counts = {
+            order_id: rows.count(idx) for idx, order_id in enumerate(order_ids)
+        }
+
+        chunks = list(_iter_mtr_chunks(file_doc.name, chunk_size=2))
+        self.assertEqual(get_line_counts(lines for lines, _ in chunks), line_counts)
+
+        # resuming from the offset of a chunk yields all lines of the orders not
+        # yielded yet, and does not yield split orders again
+        for idx, (_, offset) in enumerate(chunks):
+            resumed = get_line_counts(
+                lines
+                for lines, _ in _iter_mtr_chunks(
+                    file_doc.name, chunk_size=2, offset=offset
+                )
+            )
+            yielded = {
+                d for lines, _ in chunks[: idx + 1] for d in lines[mcols.ORDER_ID]
+            }
+            self.assertEqual(set(resumed) | yielded, set(order_ids))
+            for order_id, count in resumed.items():
+                self.assertEqual(count, line_counts[order_id])
+            self.assertFalse(set(resumed) & yielded & set(order_ids[:2]))
+
+    def test_mtr_processing_resumes_from_checkpoint(self):
+        amz_setting = make_amazon_sp_settings()
+        order_ids = self.get_order_ids(7)
+        mtr_lines = [
+            {mcols.ORDER_ID: order_id} for order_id in order_ids for _ in range(2)
+        ]
+        file_doc = self.make_mtr_file(mtr_lines)
+        invoiced = []
+
+        def process_order(processor, order_id, lines, is_b2b):
+            invoiced.append(order_id)
+            processor.checkpoint.add_order(order_id)
+
+        with patch.object(MTRFileProcessor, "process_order", process_order), patch(
+            MTR_CHUNK_SIZE, 4
+        ), patch.object(frappe.db, "commit"):
+            checkpoint = MemoryCheckpoint(order_budget=3)
+            processor = MTRFileProcessor(amz_setting.name, checkpoint=checkpoint)
+            self.assertFalse(processor.process(file_doc.name))
+            self.assertEqual(invoiced, order_ids[:3])
+
+            # a new job picks up from the saved offset and processed orders
+            checkpoint = MemoryCheckpoint(
+                order_budget=10,
+                offset=checkpoint.offset,
+                processed_order_ids=checkpoint.processed_order_ids,
+            )
+            processor = MTRFileProcessor(amz_setting.name, checkpoint=checkpoint)
+            self.assertTrue(processor.process(file_doc.name))
+
+        self.assertEqual(invoiced, order_ids)
+        self.assertEqual(checkpoint.offset, len(mtr_lines))
@@ -0,0 +1,131 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+import frappe
+import redis
+from frappe.utils import cstr
+
+EXISTING_VALUES_CHUNK_SIZE = 1000
+CLAIM_EXPIRY = 24 * 60 * 60
+# a done claim is kept for longer than any open transaction, so jobs that do not see
+# the committed document yet still skip it
+CLAIM_DONE = "done"
+CLAIM_DONE_EXPIRY = 15 * 60
+JOB_CLAIM_PREFIX = "amazon_sp_erpnext:job"
+DEFAULT_JOB_TIMEOUT = 60 * 60
+# job claims also cover the time the job waits in the queue, so they outlive the job
+JOB_CLAIM_QUEUE_TIME = 60 * 60
+
+
+def get_existing_values(doctype, fieldname, values, chunk_size=None):
+    """Returns a dict of {value: name} for the documents of `doctype` whose `fieldname`
+    is in `values`. Values are queried in chunks to keep the `IN` lists bounded."""
+    chunk_size = chunk_size or EXISTING_VALUES_CHUNK_SIZE
+    values = list({d for d in values if d})
+
+    existing = {}
+    for idx in range(0, len(values), chunk_size):
+        for d in frappe.get_all(
+            doctype,
+            filters={fieldname: ("in", values[idx : idx + chunk_size])},
+            fields=["name", fieldname],
+        ):
+            existing.setdefault(d.get(fieldname), d.name)
+    return existing
+
+
+class Claims(object):
+    """Insert-or-skip guard across background jobs. A value is claimed with an atomic
+    redis `SET NX`, so only one job processes it. Claims of values that were not
+    processed should be released so they can be retried, and claims of values that
+    were committed marked done with `complete_all`."""
+
+    def __init__(self, prefix, expiry=None) -> None:
+        self.prefix = prefix
+        self.expiry = expiry or CLAIM_EXPIRY
+        self.claimed = set()
+
+    def get_key(self, value):
+        return frappe.cache().make_key(f"{self.prefix}:{value}")
+
+    def claim(self, value) -> bool:
+        try:
+            if not frappe.cache().set(self.get_key(value), 1, nx=True, ex=self.expiry):
+                return False
+        except redis.exceptions.ConnectionError:
+            pass
+        self.claimed.add(value)
+        return True
+
+    def release(self, value) -> None:
+        self.claimed.discard(value)
+        try:
+            frappe.cache().delete(self.get_key(value))
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def release_all(self) -> None:
+        for value in list(self.claimed):
+            self.release(value)
+
+    def is_claimed(self, value) -> bool:
+        try:
+            return frappe.cache().get(self.get_key(value)) is not None
+        except redis.exceptions.ConnectionError:
+            return False
+
+    def is_done(self, value) -> bool:
+        try:
+            return cstr(frappe.cache().get(self.get_key(value))) == CLAIM_DONE
+        except redis.exceptions.ConnectionError:
+            return False
+
+    def complete_all(self) -> None:
+        """Marks the claimed values done. They expire after CLAIM_DONE_EXPIRY, after
+        which the committed documents are the guard."""
+        try:
+            for value in self.claimed:
+                frappe.cache().set(
+                    self.get_key(value), CLAIM_DONE, ex=CLAIM_DONE_EXPIRY
+                )
+        except redis.exceptions.ConnectionError:
+            pass
+        self.claimed = set()
+
+
+def enqueue_once(method, dedupe_key, queue="default", timeout=None, **kwargs):
+    """Enqueues `method` when the transaction commits, unless a job with the same
+    `dedupe_key` is queued or running. The key is claimed at the commit too, so a rolled
+    back transaction leaves no claim behind. Returns False if the job was not enqueued.
+    """
+    timeout = timeout or DEFAULT_JOB_TIMEOUT
+    claims = Claims(JOB_CLAIM_PREFIX, expiry=timeout + JOB_CLAIM_QUEUE_TIME)
+    if claims.is_claimed(dedupe_key):
+        return False
+
+    def enqueue():
+        if not claims.claim(dedupe_key):
+            return
+        try:
+            frappe.enqueue(
+                run_once,
+                queue=queue,
+                timeout=timeout,
+                job_name=dedupe_key,
+                job_method=method,
+                dedupe_key=dedupe_key,
+                **kwargs,
+            )
+        except Exception:
+            claims.release(dedupe_key)
+            raise
+
+    frappe.db.after_commit.add(enqueue)
+    return True
+
+
+def run_once(job_method, dedupe_key, **kwargs):
+    try:
+        return job_method(**kwargs)
+    finally:
+        Claims(JOB_CLAIM_PREFIX).release(dedupe_key)
@@ -21,5 +21,19 @@ frappe.ui.form.on("Amazon On Demand Report", {
         __("Action")
       );
     }
+
+    if (
+      (frm.doc.shards || []).some(
+        (d) => d.status == "Failed" || (d.status == "Completed" && d.failed_count)
+      )
+    ) {
+      frm.add_custom_button(
+        __("Retry Failed Shards"),
+        function () {
+          frm.call("retry_failed_shards").then(() => frm.reload_doc());
+        },
+        __("Action")
+      );
+    }
   },
 });
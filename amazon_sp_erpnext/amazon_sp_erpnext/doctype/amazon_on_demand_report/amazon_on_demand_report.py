@@ -3,20 +3,66 @@
 
 import frappe
 from frappe.utils import (
+    cint,
+    escape_html,
     now_datetime,
     add_to_date,
     get_datetime,
     time_diff_in_seconds,
 )
 from frappe.model.document import Document
-import time
+import contextvars
 import io, json, pytz
-from sp_api.api import Reports, Sales
-from sp_api.base import Marketplaces, ReportType, ProcessingStatus, Granularity
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sp_api.api import Reports
+from sp_api.base import Marketplaces, ProcessingStatus
 
 from amazon_sp_erpnext.amazon_sp_erpnext.controllers.sales_invoice_controller import (
+    get_shard_order_counts,
     process_mtr_file,
 )
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.mtr_preflight import (
+    preflight_mtr_file,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.report_planner import (
+    log_abandoned_window,
+    plan_report_windows,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.utils import (
+    Claims,
+    enqueue_once,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_api import (
+    Util,
+    iter_pages,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_throttle import (
+    RateLimiter,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_on_demand_report_shard.amazon_on_demand_report_shard import (
+    MTRShardCheckpoint,
+    reset_checkpoint,
+)
+
+# seconds between polls of a report, doubled for each poll without a status change
+REPORT_POLL_INTERVALS = {
+    "GET_GST_MTR_B2B_CUSTOM": 120,
+    "GET_GST_MTR_B2C_CUSTOM": 120,
+    "GET_GST_STR_ADHOC": 120,
+}
+DEFAULT_REPORT_POLL_INTERVAL = 60
+REPORT_POLL_AGE_FACTOR = 0.25
+REPORT_POLL_MAX_INTERVAL = 30 * 60
+# getReports lists the reports created in the last 90 days
+REPORT_MAX_AGE_DAYS = 90
+
+REPORT_CREATE_MAX_WORKERS = 8
+REPORT_DOWNLOAD_TIMEOUT = 30 * 60
+DEFAULT_MTR_REPORT_CONCURRENCY = 2
+
+MTR_SHARD_TIMEOUT = 60 * 60 * 2
+# stop and re-enqueue well before the job timeout
+MTR_SHARD_TIME_BUDGET = 60 * 60 * 1.5
 
 
 def to_amz_utc(date_str):
@@ -36,24 +82,35 @@ class AmazonOnDemandReport(Document):
         if not self.end_time:
             self.end_time = current_time
 
+    def on_update(self):
+        if self.has_value_changed("status"):
+            log_abandoned_window(self)
+
     def after_insert(self):
+        if self.flags.skip_create_report:
+            # created in a batch by `create_reports`
+            return
+
         frappe.enqueue_doc(
             self.doctype,
             self.name,
             "create_report",
             queue="long",
             timeout=60 * 60 * 2,
-            now=True,
+            enqueue_after_commit=True,
         )
-        frappe.db.commit()
 
     def create_report(self):
         """Create report in Amz. The report will be queued.
         Poll with the Report ID returned, to get report when status is DONE"""
 
         settings = frappe.get_doc("Amazon SP Settings", self.amazon_settings)
-        credentials = settings.get_credentials()
+        report_id = self.request_report(settings.get_credentials())
+        self.set_report_id(report_id)
 
+    def request_report(self, credentials):
+        """Requests the report from Amazon and returns the report id. Makes no database
+        calls, so it can run in a thread."""
         res = Reports(credentials=credentials, marketplace=Marketplaces.IN)
 
         # datetime format: "2022-10-06T20:11:24.000Z"
@@ -69,14 +126,36 @@ class AmazonOnDemandReport(Document):
             dataEndTime=to_amz_utc(self.end_time),
         )
 
-        report_id = data.payload["reportId"]
+        return data.payload["reportId"]
+
+    def set_report_id(self, report_id):
         self.db_set("status", "IN_QUEUE")
         self.db_set("report_id", report_id)
 
+    @frappe.whitelist()
+    def retry_failed_shards(self):
+        """Re-enqueues the failed shards and the completed shards with failed orders.
+        Failed orders are behind the checkpoint, so the shards are processed again from
+        the start of the file, skipping the orders already invoiced."""
+        retried = [
+            d
+            for d in self.shards
+            if d.status == "Failed" or (d.status == "Completed" and d.failed_count)
+        ]
+        for d in retried:
+            reset_checkpoint(d.name)
+            frappe.db.set_value(d.doctype, d.name, "status", "Failed")
+        if retried:
+            self.db_set("is_processed", 0)
+        resume_mtr_shards(self.name, ["Failed"])
+
 
 def get_report_scheduled():
-    """runs in cron to fetch reports in queue or in progress from seller central"""
+    """runs in cron to fetch reports in queue or in progress from seller central.
+    Reports are polled per account, with one Reports client and a getReports listing
+    of the reports that changed since they were queued."""
 
+    reports_by_account = {}
     for d in frappe.get_all(
         "Amazon On Demand Report",
         filters={
@@ -87,93 +166,683 @@ def get_report_scheduled():
                     ProcessingStatus.FATAL,
                     ProcessingStatus.CANCELLED,
                 ),
-            ]
+            ],
+            "report_id": ("is", "set"),
         },
+        # skip reports whose next poll is not due yet
+        or_filters=[
+            ["next_poll_at", "is", "not set"],
+            ["next_poll_at", "<=", now_datetime()],
+        ],
+        fields=[
+            "name",
+            "amazon_settings",
+            "report_id",
+            "report_type",
+            "status",
+            "poll_attempts",
+            "creation",
+        ],
     ):
-        doc = frappe.get_doc("Amazon On Demand Report", d.name)
+        reports_by_account.setdefault(d.amazon_settings, []).append(d)
+
+    for amazon_settings, reports in reports_by_account.items():
+        try:
+            poll_account_reports(amazon_settings, reports)
+        except Exception:
+            frappe.log_error(title="Error polling reports for %s" % amazon_settings)
+
+    retry_report_downloads()
+    dispatch_mtr_reports()
+
+
+def poll_account_reports(amazon_settings, reports):
+    max_age_limit = get_report_max_age_limit()
+    for d in reports:
+        if get_datetime(d.creation) < max_age_limit:
+            expire_report(d.name)
+    reports = [d for d in reports if get_datetime(d.creation) >= max_age_limit]
+    if not reports:
+        return
+
+    settings = frappe.get_doc("Amazon SP Settings", amazon_settings)
+    credentials = settings.get_credentials()
+    reports_api = Reports(credentials=credentials, marketplace=Marketplaces.IN)
+
+    rate_limiter = get_rate_limiter(credentials)
+
+    payloads = {}
+    if report_types := {d.report_type for d in reports if d.report_type}:
+        payloads = get_changed_reports(
+            reports_api,
+            rate_limiter,
+            report_types=report_types,
+            created_since=min(d.creation for d in reports),
+        )
+
+    for d in reports:
+        if not d.report_type:
+            rate_limiter.acquire("getReport")
+            payloads[d.report_id] = reports_api.get_report(d.report_id).payload
+
+        # reports not listed are still in queue
+        payload = payloads.get(d.report_id)
+        if payload and payload.get("processingStatus") != d.status:
+            update_report_status(d.name, payload)
+        else:
+            schedule_next_poll(d)
+
+
+def get_poll_interval(report_type, attempts, age):
+    """Returns the seconds to wait before polling a report again. The interval doubles
+    with each poll, from a base for the report type, and is at least a fraction of the
+    report's age, up to REPORT_POLL_MAX_INTERVAL."""
+    interval = REPORT_POLL_INTERVALS.get(report_type, DEFAULT_REPORT_POLL_INTERVAL)
+    return min(
+        REPORT_POLL_MAX_INTERVAL,
+        max(interval * 2 ** cint(attempts), age * REPORT_POLL_AGE_FACTOR),
+    )
+
+
+def schedule_next_poll(report):
+    attempts = cint(report.poll_attempts) + 1
+    interval = get_poll_interval(
+        report.report_type,
+        attempts,
+        time_diff_in_seconds(now_datetime(), report.creation),
+    )
+    frappe.db.set_value(
+        "Amazon On Demand Report",
+        report.name,
+        {
+            "poll_attempts": attempts,
+            "next_poll_at": add_to_date(now_datetime(), seconds=interval),
+        },
+        update_modified=False,
+    )
+
+
+def get_changed_reports(reports_api, rate_limiter, report_types, created_since):
+    """Returns {report id: report} of the reports of `report_types`, created since
+    `created_since`, that are no longer in queue. Pages are fetched within the getReports
+    rate limit of the account."""
+    kwargs = {
+        "reportTypes": sorted(report_types),
+        "processingStatuses": [
+            ProcessingStatus.IN_PROGRESS,
+            ProcessingStatus.DONE,
+            ProcessingStatus.FATAL,
+            ProcessingStatus.CANCELLED,
+        ],
+        "createdSince": to_amz_utc(
+            max(
+                get_datetime(add_to_date(created_since, minutes=-5)),
+                get_report_max_age_limit(),
+            )
+        ),
+        "pageSize": 100,
+    }
+
+    def fetch_page(next_token):
+        rate_limiter.acquire("getReports")
+        # other parameters must not be sent with the next token
+        data = reports_api.get_reports(
+            **({"nextToken": next_token} if next_token else kwargs)
+        )
+        rate_limiter.learn("getReports", getattr(data, "headers", None) or {})
+        return {
+            **data.payload,
+            "nextToken": getattr(data, "next_token", None)
+            or data.payload.get("nextToken"),
+        }
+
+    return {
+        d.get("reportId"): d
+        for payload in iter_pages(fetch_page)
+        for d in payload.get("reports") or []
+    }
+
 
+def get_report_max_age_limit():
+    """Returns the oldest creation time getReports lists reports for, with a margin."""
+    return add_to_date(now_datetime(), days=-REPORT_MAX_AGE_DAYS, hours=1)
+
+
+def expire_report(name):
+    """Marks a report that is still pending after REPORT_MAX_AGE_DAYS as FATAL, so that
+    it is no longer polled and its window is requested again."""
+    doc = frappe.get_doc("Amazon On Demand Report", name)
+    doc.add_comment(
+        text="Report expired, still {} after {} days.".format(
+            doc.status or "pending", REPORT_MAX_AGE_DAYS
+        )
+    )
+    doc.status = ProcessingStatus.FATAL
+    doc.save()
+
+
+def update_report_status(name, payload):
+    """Updates a report whose status changed. The report payload is added as a comment,
+    as the status history of the report."""
+    doc = frappe.get_doc("Amazon On Demand Report", name)
+    doc.update(
+        {
+            "status": payload.get("processingStatus"),
+            "time_taken": time_diff_in_seconds(now_datetime(), doc.creation),
+            "poll_attempts": 0,
+            "next_poll_at": add_to_date(
+                now_datetime(),
+                seconds=get_poll_interval(
+                    doc.report_type,
+                    0,
+                    time_diff_in_seconds(now_datetime(), doc.creation),
+                ),
+            ),
+        }
+    )
+    doc.add_comment(text=json.dumps(payload))
+    doc.save()
+    # frappe.db.commit()
+
+    if doc.status in [ProcessingStatus.DONE]:
+        enqueue_report_download(doc.name, payload["reportDocumentId"])
+
+
+def enqueue_report_download(name, report_document_id=None):
+    return enqueue_once(
+        download_report,
+        "amazon_report_download:{}".format(name),
+        queue=get_mtr_queue(),
+        timeout=REPORT_DOWNLOAD_TIMEOUT,
+        name=name,
+        report_document_id=report_document_id,
+    )
+
+
+def retry_report_downloads():
+    """Re-enqueues the download of DONE reports without a file, e.g. when the download
+    job failed. Retries are backed off with next_poll_at, like polls of the report."""
+    for d in frappe.db.sql(
+        """
+    select
+        r.name, r.report_type, r.poll_attempts, r.creation
+    from `tabAmazon On Demand Report` r
+    where r.status = %s and r.is_processed = 0 and r.creation >= %s
+    and (r.next_poll_at is null or r.next_poll_at <= %s)
+    and not exists (
+        select 1 from tabFile f
+        where f.attached_to_doctype = 'Amazon On Demand Report'
+        and f.attached_to_name = r.name)
+    """,
+        (ProcessingStatus.DONE, get_report_max_age_limit(), now_datetime()),
+        as_dict=True,
+    ):
+        # not enqueued while the download job is queued or running
+        if enqueue_report_download(d.name):
+            schedule_next_poll(d)
+    frappe.db.commit()
+
+
+def get_mtr_queue():
+    return (
+        frappe.db.get_single_value("Amazon SP Common Settings", "mtr_queue") or "long"
+    )
+
+
+def download_report(name, report_document_id=None):
+    """Downloads the document of a DONE report and attaches it to the report. The
+    document id is looked up with getReport when not given. Processing of the file is
+    enqueued separately by `dispatch_mtr_reports`."""
+    doc = frappe.get_doc("Amazon On Demand Report", name)
+
+    if not get_report_file(name):
         settings = frappe.get_doc("Amazon SP Settings", doc.amazon_settings)
         credentials = settings.get_credentials()
         reports_api = Reports(credentials=credentials, marketplace=Marketplaces.IN)
 
-        data = reports_api.get_report(doc.report_id)
+        if not report_document_id:
+            get_rate_limiter(credentials).acquire("getReport")
+            report_document_id = reports_api.get_report(doc.report_id).payload[
+                "reportDocumentId"
+            ]
 
-        doc.update(
+        buffer = io.BytesIO()
+        reports_api.get_report_document(
+            report_document_id,
+            decrypt=True,
+            file=buffer,
+        )
+
+        frappe.get_doc(
             {
-                "status": data.payload.get("processingStatus"),
-                "time_taken": time_diff_in_seconds(now_datetime(), doc.creation),
+                "doctype": "File",
+                "file_name": "{}_{}.csv".format(doc.report_type, doc.start_time),
+                "content": buffer.getvalue(),
+                "is_private": True,
+                "attached_to_doctype": doc.doctype,
+                "attached_to_name": doc.name,
             }
+        ).insert()
+        frappe.db.commit()
+
+    dispatch_mtr_reports()
+
+
+@frappe.whitelist()
+def process_mtr_report_scheduled(name=None, amazon_settings=None):
+    """Enqueues processing of a report, or of the downloaded reports that are DONE,
+    within the MTR Report Concurrency. The processing job checks the file with
+    `preflight_mtr_file` first, and comments the lines that cannot be invoiced."""
+    if name and amazon_settings:
+        pending, shard_count = get_pending_shard_count(name)
+        if pending:
+            frappe.msgprint(
+                "Report is already processing, {} of {} shards pending.".format(
+                    pending, shard_count
+                )
+            )
+            return
+
+        file_name = get_report_file(name)
+        if not file_name:
+            frappe.throw("Report file is not downloaded yet.")
+
+        if shard_count:
+            # processed before, split again to invoice the orders not invoiced yet
+            reset_mtr_shards(name)
+
+        if enqueue_report_processing(name, amazon_settings):
+            frappe.msgprint(
+                "Enqueued job for processing file. Orders that cannot be invoiced will "
+                "be commented on the report."
+            )
+        else:
+            frappe.msgprint("Report is already queued for processing.")
+    else:
+        dispatch_mtr_reports()
+
+
+def get_pending_shard_count(name):
+    """Returns (pending shards, shards) of a report, (0, 0) if it is not split."""
+    statuses = frappe.get_all(
+        "Amazon On Demand Report Shard", filters={"parent": name}, pluck="status"
+    )
+    return len([d for d in statuses if d != "Completed"]), len(statuses)
+
+
+def reset_mtr_shards(name):
+    doc = frappe.get_doc("Amazon On Demand Report", name)
+    doc.shards = []
+    doc.is_processed = 0
+    doc.save()
+
+
+def add_preflight_errors(name, summary):
+    """Comments the orders of the report that cannot be invoiced, per reason, and shows
+    them to the user who enqueued the processing."""
+    if not summary.get("errors"):
+        return
+
+    message = "<br>".join(
+        "{}: {} orders, {} lines ({})".format(
+            reason, d["orders"], d["lines"], escape_html(", ".join(d["values"]))
         )
-        doc.add_comment(text=json.dumps(data.payload))
+        for reason, d in summary["errors"].items()
+    )
+    frappe.get_doc("Amazon On Demand Report", name).add_comment(
+        "Comment", "<b>Orders that cannot be invoiced</b><br>{}".format(message)
+    )
+    frappe.msgprint(
+        message,
+        title="Orders that cannot be invoiced",
+        indicator="orange",
+        realtime=True,
+    )
+
 
-        if doc.status in [ProcessingStatus.DONE]:
-            buffer = io.BytesIO()
-            out = reports_api.get_report_document(
-                data.payload["reportDocumentId"],
-                decrypt=True,
-                file=buffer,
+def dispatch_mtr_reports():
+    """Enqueues processing of downloaded reports, oldest first, so that at most MTR Report
+    Concurrency (Amazon SP Common Settings) reports are being processed at a time."""
+    concurrency = (
+        cint(
+            frappe.db.get_single_value(
+                "Amazon SP Common Settings", "mtr_report_concurrency"
             )
+        )
+        or DEFAULT_MTR_REPORT_CONCURRENCY
+    )
+    in_process = frappe.db.sql("""
+    select count(distinct parent) 
+    from `tabAmazon On Demand Report Shard` 
+    where status in ('Queued', 'Processing')
+    """)[0][0]
 
-            file_doc = frappe.get_doc(
-                {
-                    "doctype": "File",
-                    "file_name": "{}_{}.csv".format(doc.report_type, doc.start_time),
-                    "content": buffer.getvalue(),
-                    "is_private": True,
-                    "attached_to_doctype": doc.doctype,
-                    "attached_to_name": doc.name,
-                }
-            ).insert()
+    if in_process >= concurrency:
+        return
 
-            # doc.add_comment(text=file_doc.as_json())
-            process_mtr_report_scheduled()
+    for name, amazon_settings in frappe.db.sql(
+        """
+    select 
+        r.name, r.amazon_settings
+    from `tabAmazon On Demand Report` r 
+    where r.status = %s and r.is_processed = 0 
+    and exists (
+        select 1 from tabFile f 
+        where f.attached_to_doctype = 'Amazon On Demand Report' 
+        and f.attached_to_name = r.name)
+    and not exists (
+        select 1 from `tabAmazon On Demand Report Shard` s where s.parent = r.name)
+    order by r.creation 
+    limit %s
+    """,
+        (ProcessingStatus.DONE, concurrency - in_process),
+    ):
+        enqueue_report_processing(name, amazon_settings)
 
-        doc.save()
-        # frappe.db.commit()
 
+def enqueue_report_processing(name, amazon_settings):
+    return enqueue_once(
+        process_report,
+        "amazon_report_process:{}".format(name),
+        queue=get_mtr_queue(),
+        timeout=MTR_SHARD_TIMEOUT,
+        name=name,
+        amazon_settings=amazon_settings,
+    )
 
-@frappe.whitelist()
-def process_mtr_report_scheduled(name=None, amazon_settings=None):
-    """runs in a cron to process reports that are DONE"""
-
-    def _process_aod_report(name, amazon_settings):
-        for f in frappe.db.get_all(
-            "File",
-            filters={
-                "attached_to_doctype": "Amazon On Demand Report",
-                "attached_to_name": ("in", name),
-            },
-            fields=["file_url", "name"],
-            limit_page_length=1,
-        ):
-            frappe.msgprint("Enqueued job for processing file.")
-            process_mtr_file(f.name, amazon_settings, submit=False)
-            frappe.db.set_value("Amazon On Demand Report", name, "is_processed", 1)
-            frappe.db.commit()
 
-    if name and amazon_settings:
-        _process_aod_report(name, amazon_settings)
-    else:
-        for d in frappe.get_all(
-            "Amazon On Demand Report",
-            filters={
-                "status": ProcessingStatus.DONE,
-                "is_processed": 0,
+def process_report(name, amazon_settings):
+    file_name = get_report_file(name)
+    if file_name:
+        # checked in the job, as it reads the whole file
+        add_preflight_errors(name, preflight_mtr_file(file_name, amazon_settings))
+        shard_count = cint(
+            frappe.db.get_single_value("Amazon SP Common Settings", "mtr_shard_count")
+        )
+        enqueue_mtr_shards(name, file_name, amazon_settings, max(shard_count, 1))
+
+
+def get_report_file(name):
+    for f in frappe.db.get_all(
+        "File",
+        filters={
+            "attached_to_doctype": "Amazon On Demand Report",
+            "attached_to_name": ("in", name),
+        },
+        fields=["file_url", "name"],
+        limit_page_length=1,
+    ):
+        return f.name
+
+
+def enqueue_mtr_shards(name, file_name, amazon_settings, shard_count):
+    """Splits the orders of the report file into shards, each invoiced by a job on the
+    long queue. Progress is tracked in the shards table of the report. Returns the
+    number of shards enqueued, 0 if the report was already split."""
+    doc = frappe.get_doc("Amazon On Demand Report", name)
+    if doc.shards:
+        # already split, shards are processed or retried by their own jobs
+        return 0
+
+    order_counts = get_shard_order_counts(file_name, shard_count)
+    for shard in range(shard_count):
+        doc.append(
+            "shards",
+            {
+                "shard": shard,
+                "status": "Queued",
+                "order_count": order_counts.get(shard, 0),
             },
-            fields=["name", "amazon_settings"],
+        )
+    doc.save()
+
+    for d in doc.shards:
+        enqueue_mtr_shard(
+            name, d.name, file_name, amazon_settings, d.shard, shard_count
+        )
+    frappe.db.commit()
+    return shard_count
+
+
+def enqueue_mtr_shard(
+    report_name, shard_name, file_name, amazon_settings, shard, shard_count
+):
+    frappe.enqueue(
+        process_mtr_shard,
+        queue=get_mtr_queue(),
+        timeout=MTR_SHARD_TIMEOUT,
+        enqueue_after_commit=True,
+        report_name=report_name,
+        shard_name=shard_name,
+        file_name=file_name,
+        amazon_settings=amazon_settings,
+        shard=shard,
+        shard_count=shard_count,
+    )
+
+
+def process_mtr_shard(
+    report_name, shard_name, file_name, amazon_settings, shard, shard_count
+):
+    """Invoices the orders of one shard of a report, resuming from the shard's checkpoint.
+    When the time budget is spent, the job commits its progress and enqueues itself to
+    continue. The report is marked processed when its last shard is completed."""
+    claims = Claims("amazon_sp_erpnext:mtr_shard", expiry=MTR_SHARD_TIMEOUT)
+    if not claims.claim(shard_name):
+        # another job is processing the shard
+        return
+
+    try:
+        is_completed = _process_mtr_shard(
+            report_name, shard_name, file_name, amazon_settings, shard, shard_count
+        )
+    finally:
+        claims.release(shard_name)
+
+    if is_completed is False:
+        # continue in a new job, once this one released the shard
+        enqueue_mtr_shard(
+            report_name, shard_name, file_name, amazon_settings, shard, shard_count
+        )
+        frappe.db.commit()
+
+
+def _process_mtr_shard(
+    report_name, shard_name, file_name, amazon_settings, shard, shard_count
+):
+    """Returns True if the shard is completed, False if it is to be continued and None
+    if it failed."""
+    frappe.db.set_value(
+        "Amazon On Demand Report Shard",
+        shard_name,
+        {
+            "status": "Processing",
+            "runs": cint(
+                frappe.db.get_value("Amazon On Demand Report Shard", shard_name, "runs")
+            )
+            + 1,
+        },
+    )
+    frappe.db.commit()
+
+    checkpoint = MTRShardCheckpoint(shard_name, time_budget=MTR_SHARD_TIME_BUDGET)
+    try:
+        is_completed = process_mtr_file(
+            file_name,
+            amazon_settings,
+            submit=False,
+            shard=shard,
+            shard_count=shard_count,
+            checkpoint=checkpoint,
+        )
+    except Exception:
+        frappe.db.rollback()
+        frappe.db.set_value(
+            "Amazon On Demand Report Shard",
+            shard_name,
+            {"status": "Failed", "error": frappe.get_traceback()},
+        )
+        frappe.log_error(
+            title="Error processing shard {} of {}".format(shard, report_name)
+        )
+        frappe.db.commit()
+        return
+
+    if not is_completed:
+        frappe.db.set_value(
+            "Amazon On Demand Report Shard", shard_name, "status", "Queued"
+        )
+        frappe.db.commit()
+        return False
+
+    frappe.db.set_value(
+        "Amazon On Demand Report Shard", shard_name, "status", "Completed"
+    )
+    frappe.db.commit()
+
+    if not frappe.db.exists(
+        "Amazon On Demand Report Shard",
+        {"parent": report_name, "status": ("!=", "Completed")},
+    ):
+        frappe.db.set_value("Amazon On Demand Report", report_name, "is_processed", 1)
+        frappe.db.commit()
+        dispatch_mtr_reports()
+    return True
+
+
+def resume_mtr_shards(name, statuses, stale_before=None):
+    doc = frappe.get_doc("Amazon On Demand Report", name)
+    file_name = get_report_file(name)
+
+    for d in doc.shards:
+        if d.status in statuses and (
+            not stale_before or get_datetime(d.modified) < get_datetime(stale_before)
         ):
-            _process_aod_report(d.name, d.amazon_settings)
+            frappe.db.set_value(d.doctype, d.name, "status", "Queued")
+            enqueue_mtr_shard(
+                name,
+                d.name,
+                file_name,
+                doc.amazon_settings,
+                d.shard,
+                len(doc.shards),
+            )
+    frappe.db.commit()
+
+
+def resume_mtr_shards_scheduled():
+    """Re-enqueues shards whose job stopped without saving progress, or was not started,
+    for longer than the job timeout, e.g. when the worker was restarted or the queue
+    was lost. They resume from their checkpoint."""
+    stale_before = add_to_date(now_datetime(), seconds=-MTR_SHARD_TIMEOUT)
+    for report_name in frappe.get_all(
+        "Amazon On Demand Report Shard",
+        filters={
+            "status": ("in", ("Queued", "Processing")),
+            "modified": ("<", stale_before),
+        },
+        pluck="parent",
+        distinct=True,
+    ):
+        resume_mtr_shards(
+            report_name, ["Queued", "Processing"], stale_before=stale_before
+        )
 
 
 def create_amazon_reports_scheduled():
-    """Creates a report for each report_type on the hour (or as scheduled in hooks.py)"""
+    """Creates reports for each report_type on the hour (or as scheduled in hooks.py),
+    for the windows from the last report to now, as planned by `plan_report_windows`"""
+    names = []
     for d in [
         "GET_GST_MTR_B2B_CUSTOM",
         # "GET_GST_MTR_B2C_CUSTOM",
         # "GST_MTR_STOCK_TRANSFER_REPORT",
     ]:
         for setting in frappe.get_all("Amazon SP Settings"):
-            doc = frappe.get_doc(
-                {"doctype": "Amazon On Demand Report", "amazon_settings": setting.name}
+            for start_time, end_time in plan_report_windows(setting.name, d):
+                doc = frappe.get_doc(
+                    {
+                        "doctype": "Amazon On Demand Report",
+                        "amazon_settings": setting.name,
+                        "report_type": d,
+                        "start_time": start_time,
+                        "end_time": end_time,
+                    }
+                )
+                doc.flags.skip_create_report = True
+                doc.save()
+                names.append(doc.name)
+
+    frappe.db.commit()
+    create_reports(names)
+
+
+def get_rate_limiter(credentials):
+    """Returns the RateLimiter of the seller account, shared with the SP-API client."""
+    return RateLimiter(
+        Util.get_hash(credentials.get("lwa_app_id"), credentials.get("refresh_token"))
+    )
+
+
+def create_reports(names):
+    """Requests the reports from Amazon concurrently, one thread per account. The reports
+    of an account are requested in turn, within its createReport rate limit."""
+    reports_by_account = {}
+    for name in names:
+        doc = frappe.get_doc("Amazon On Demand Report", name)
+        reports_by_account.setdefault(doc.amazon_settings, []).append(doc)
+
+    def request_account_reports(credentials, docs):
+        try:
+            rate_limiter = get_rate_limiter(credentials)
+        except Exception:
+            # e.g. an account with missing credentials, its reports are skipped
+            error = frappe.get_traceback()
+            return [(doc, None, error) for doc in docs]
+
+        results = []
+        for doc in docs:
+            try:
+                rate_limiter.acquire("createReport")
+                results.append((doc, doc.request_report(credentials), None))
+            except Exception:
+                results.append((doc, None, frappe.get_traceback()))
+        return results
+
+    # credentials are read in this thread, an account that fails is logged and skipped
+    credentials_by_account = {}
+    for amazon_settings in list(reports_by_account):
+        try:
+            credentials_by_account[amazon_settings] = frappe.get_doc(
+                "Amazon SP Settings", amazon_settings
+            ).get_credentials()
+        except Exception:
+            frappe.log_error(title="Error creating reports for %s" % amazon_settings)
+            for doc in reports_by_account.pop(amazon_settings):
+                doc.db_set("status", ProcessingStatus.FATAL)
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(reports_by_account), REPORT_CREATE_MAX_WORKERS) or 1
+    ) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                request_account_reports,
+                credentials_by_account[amazon_settings],
+                docs,
             )
-            doc.save()
+            for amazon_settings, docs in reports_by_account.items()
+        ]
+
+        # database writes stay in this thread
+        for future in as_completed(futures):
+            for doc, report_id, error in future.result():
+                if report_id:
+                    doc.set_report_id(report_id)
+                else:
+                    # failed windows are requested again by `plan_report_windows`
+                    doc.db_set("status", ProcessingStatus.FATAL)
+                    frappe.log_error(
+                        title="Error creating report %s" % doc.name, message=error
+                    )
+            frappe.db.commit()
@@ -1,9 +1,160 @@
 # Copyright (c) 2022, Greycube and Contributors
 # See license.txt
 
-# import frappe
+import random
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.report_planner import (
+    REPORT_MAX_ATTEMPTS,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_on_demand_report.amazon_on_demand_report import (
+    process_mtr_report_scheduled,
+    process_report,
+    retry_report_downloads,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.test_amazon_sp_settings import (
+    make_amazon_sp_settings,
+)
+
+REPORT_MODULE = "amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_on_demand_report.amazon_on_demand_report"
+
+
+def make_report(shards, **kwargs):
+    doc = frappe.get_doc(
+        {
+            "doctype": "Amazon On Demand Report",
+            "amazon_settings": make_amazon_sp_settings().name,
+            "report_type": "GET_GST_MTR_B2B_CUSTOM",
+            "status": "DONE",
+            "shards": shards,
+            **kwargs,
+        }
+    )
+    doc.flags.skip_create_report = True
+    return doc.insert(ignore_permissions=True)
 
 
 class TestAmazonOnDemandReport(FrappeTestCase):
-	pass
+    def process_report(self, doc):
+        with patch(f"{REPORT_MODULE}.get_report_file", return_value="mtr.csv"), patch(
+            f"{REPORT_MODULE}.enqueue_report_processing", return_value=True
+        ) as enqueue:
+            process_mtr_report_scheduled(doc.name, doc.amazon_settings)
+        doc.reload()
+        return enqueue
+
+    def test_processed_report_is_processed_again(self):
+        doc = make_report([{"shard": 0, "status": "Completed", "processed_count": 2}])
+        doc.db_set("is_processed", 1)
+
+        enqueue = self.process_report(doc)
+        enqueue.assert_called_once_with(doc.name, doc.amazon_settings)
+        self.assertFalse(doc.shards)
+        self.assertFalse(doc.is_processed)
+
+    def test_processing_report_is_not_enqueued(self):
+        doc = make_report(
+            [
+                {"shard": 0, "status": "Completed"},
+                {"shard": 1, "status": "Processing"},
+            ]
+        )
+
+        enqueue = self.process_report(doc)
+        enqueue.assert_not_called()
+        self.assertEqual(len(doc.shards), 2)
+
+    def test_preflight_errors_are_commented(self):
+        doc = make_report([])
+        summary = {
+            "errors": {
+                "Item not found": {"orders": 2, "lines": 3, "values": ["SKU-1"]},
+            }
+        }
+
+        with patch(f"{REPORT_MODULE}.get_report_file", return_value="mtr.csv"), patch(
+            f"{REPORT_MODULE}.preflight_mtr_file", return_value=summary
+        ), patch(f"{REPORT_MODULE}.enqueue_mtr_shards") as enqueue:
+            process_report(doc.name, doc.amazon_settings)
+
+        enqueue.assert_called_once()
+        comments = frappe.get_all(
+            "Comment",
+            filters={"reference_doctype": doc.doctype, "reference_name": doc.name},
+            pluck="content",
+        )
+        self.assertEqual(len(comments), 1)
+        self.assertIn("Item not found: 2 orders, 3 lines (SKU-1)", comments[0])
+
+    def test_failed_downloads_are_retried(self):
+        doc = make_report([])
+
+        with patch(f"{REPORT_MODULE}.enqueue_once", return_value=True) as enqueue:
+            retry_report_downloads()
+            # retried after the next poll interval
+            retry_report_downloads()
+
+        calls = [d for d in enqueue.call_args_list if d.kwargs["name"] == doc.name]
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(calls[0].kwargs["report_document_id"])
+        doc.reload()
+        self.assertEqual(doc.poll_attempts, 1)
+
+        doc = make_report(
+            [
+                {"shard": 0, "status": "Completed", "processed_count": 2},
+                {
+                    "shard": 1,
+                    "status": "Completed",
+                    "processed_count": 1,
+                    "failed_count": 1,
+                    "last_offset": 4,
+                },
+                {
+                    "shard": 2,
+                    "status": "Failed",
+                    "last_offset": 2,
+                    "processed_order_ids": '["402-0000000-0000001"]',
+                },
+            ]
+        )
+        doc.db_set("is_processed", 1)
+
+        with patch(f"{REPORT_MODULE}.enqueue_mtr_shard") as enqueue:
+            doc.retry_failed_shards()
+        doc.reload()
+
+        # the shards with failed orders are processed again from the start of the file
+        self.assertEqual([d.args[4] for d in enqueue.call_args_list], [1, 2])
+        self.assertEqual(
+            [(d.status, d.last_offset, d.failed_count) for d in doc.shards],
+            [("Completed", 0, 0), ("Queued", 0, 0), ("Queued", 0, 0)],
+        )
+        self.assertEqual(doc.shards[1].processed_count, 1)
+        self.assertEqual(doc.shards[2].processed_order_ids, "[]")
+        self.assertFalse(doc.is_processed)
+
+    def test_abandoned_window_is_logged(self):
+        # a window of its own, not requested by other tests
+        start_time = add_to_date(
+            now_datetime(), days=-400, seconds=-random.randint(0, 10**6)
+        )
+        window = {
+            "start_time": start_time,
+            "end_time": add_to_date(start_time, hours=1),
+        }
+
+        for _ in range(REPORT_MAX_ATTEMPTS):
+            doc = make_report([], status="FATAL", **window)
+
+        error_logs = frappe.get_all(
+            "Error Log",
+            filters={"reference_doctype": doc.doctype, "reference_name": doc.name},
+            pluck="error",
+        )
+        self.assertEqual(len(error_logs), 1)
+        self.assertIn(f"failed {REPORT_MAX_ATTEMPTS} times", error_logs[0])
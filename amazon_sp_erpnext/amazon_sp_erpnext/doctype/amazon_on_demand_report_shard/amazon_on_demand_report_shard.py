@@ -0,0 +1,80 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+import json
+import time
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cint
+
+
+class AmazonOnDemandReportShard(Document):
+    pass
+
+
+class MTRShardCheckpoint(object):
+    """Progress of an MTR shard job, saved on its Amazon On Demand Report Shard row, so
+    that a job that was stopped or restarted resumes where the last one left off.
+
+    `offset` is the number of rows of the file that are fully processed and
+    `processed_order_ids` are the orders already processed in the chunk after it."""
+
+    def __init__(self, shard_name, time_budget=None) -> None:
+        self.shard_name = shard_name
+        self.time_budget = time_budget
+        self.started = time.monotonic()
+
+        shard = frappe.db.get_value(
+            "Amazon On Demand Report Shard",
+            shard_name,
+            ["last_offset", "processed_count", "failed_count", "processed_order_ids"],
+            as_dict=True,
+        )
+        self.offset = cint(shard.last_offset)
+        self.processed_count = cint(shard.processed_count)
+        self.failed_count = cint(shard.failed_count)
+        self.processed_order_ids = set(json.loads(shard.processed_order_ids or "[]"))
+
+    def is_expired(self) -> bool:
+        return bool(
+            self.time_budget and time.monotonic() - self.started > self.time_budget
+        )
+
+    def is_processed(self, order_id) -> bool:
+        return order_id in self.processed_order_ids
+
+    def add_order(self, order_id, failed=False) -> None:
+        # failed orders are not retried when the shard continues, only when the shard is
+        # retried from the start with `reset_checkpoint`
+        self.processed_order_ids.add(order_id)
+        if failed:
+            self.failed_count += 1
+        else:
+            self.processed_count += 1
+
+    def set_offset(self, offset) -> None:
+        self.offset = offset
+        self.processed_order_ids = set()
+
+    def save(self) -> None:
+        frappe.db.set_value(
+            "Amazon On Demand Report Shard",
+            self.shard_name,
+            {
+                "last_offset": self.offset,
+                "processed_count": self.processed_count,
+                "failed_count": self.failed_count,
+                "processed_order_ids": json.dumps(sorted(self.processed_order_ids)),
+            },
+        )
+
+
+def reset_checkpoint(shard_name) -> None:
+    """Resets the checkpoint of the shard, so that it is processed from the start of the
+    file and its failed orders are retried. The invoiced orders are counted already."""
+    frappe.db.set_value(
+        "Amazon On Demand Report Shard",
+        shard_name,
+        {"last_offset": 0, "failed_count": 0, "processed_order_ids": "[]"},
+    )
@@ -2,12 +2,75 @@
 # For license information, please see license.txt
 
 import frappe
-from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_repository_extn import (
-    AmazonRepositoryExtn,
-)
 from frappe.model.document import Document
+from frappe.utils import cint, now
 import json
 
+DEFAULT_BATCH_SIZE = 500
+LOG_FIELDS = (
+    "name",
+    "owner",
+    "modified_by",
+    "creation",
+    "modified",
+    "docstatus",
+    "idx",
+    "amazon_order_id",
+    "status",
+    "sales_invoice",
+    "error",
+    "amazon_order_json",
+)
+
 
 class AmazonOrderLog(Document):
     pass
+
+
+class AmazonOrderLogWriter(object):
+    """Buffers Amazon Order Log rows and writes them with `frappe.db.bulk_insert`,
+    skipping naming, validation, hooks and versioning of a document insert per row.
+
+    The batch size can be set with `amazon_order_log_batch_size` in site_config."""
+
+    def __init__(self, batch_size=None) -> None:
+        self.batch_size = (
+            batch_size
+            or cint(frappe.conf.get("amazon_order_log_batch_size"))
+            or DEFAULT_BATCH_SIZE
+        )
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def append(
+        self, amazon_order_id, order_json, status=None, sales_invoice=None, error=None
+    ):
+        timestamp = now()
+        self.rows.append(
+            (
+                frappe.generate_hash(length=10),
+                frappe.session.user,
+                frappe.session.user,
+                timestamp,
+                timestamp,
+                0,
+                0,
+                amazon_order_id,
+                status,
+                sales_invoice,
+                error,
+                json.dumps(order_json),
+            )
+        )
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            frappe.db.bulk_insert("Amazon Order Log", LOG_FIELDS, self.rows)
+            self.rows = []
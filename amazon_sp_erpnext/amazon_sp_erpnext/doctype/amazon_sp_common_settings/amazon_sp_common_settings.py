@@ -24,23 +24,23 @@ class AmazonSPCommonSettings(Document):
             or "Unregistered"
         )
 
+    def get_mtr_tax_column(self, order):
+        """Returns the (Amazon MTR Tax Column, Amazon MTR Tax Rate) of the order line."""
+        if order.get(mcols.SGST_RATE):
+            return "In State", order.get(mcols.SGST_RATE)
+        elif order.get(mcols.IGST_RATE):
+            return "Out State", order.get(mcols.IGST_RATE)
+
     def get_item_tax_template(self, order):
         item_tax_template = None
+        tax_column = self.get_mtr_tax_column(order)
 
-        if order.get(mcols.SGST_RATE):
-            item_tax_template = frappe.db.get_value(
-                "Item Tax Template",
-                filters={
-                    "amazon_mtr_tax_column_cf": "In State",
-                    "amazon_mtr_tax_rate_cf": order.get(mcols.SGST_RATE),
-                },
-            )
-        elif order.get(mcols.IGST_RATE):
+        if tax_column:
             item_tax_template = frappe.db.get_value(
                 "Item Tax Template",
                 filters={
-                    "amazon_mtr_tax_column_cf": "Out State",
-                    "amazon_mtr_tax_rate_cf": order.get(mcols.IGST_RATE),
+                    "amazon_mtr_tax_column_cf": tax_column[0],
+                    "amazon_mtr_tax_rate_cf": tax_column[1],
                 },
             )
 
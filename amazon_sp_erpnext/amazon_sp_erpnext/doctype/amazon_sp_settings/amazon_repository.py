@@ -2,14 +2,19 @@
 # For license information, please see license.txt
 
 
+import asyncio
 import time
-import urllib.request
+from itertools import islice
 
 import dateutil
 import frappe
 from frappe import _
 
 import amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_api as sp_api
+from amazon_sp_erpnext.amazon_sp_erpnext.controllers.utils import get_existing_values
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_throttle import (
+    get_backoff,
+)
 
 
 class AmazonRepository:
@@ -34,27 +39,47 @@ class AmazonRepository:
             return [input]
 
     def call_sp_api_method(self, sp_api_method, **kwargs):
-        errors = {}
-        max_retries = self.amz_setting.max_retry_limit
-
-        for x in range(max_retries):
+        try:
+            return self.retry_sp_api_method(sp_api_method, **kwargs)
+        except sp_api.SPAPIError as e:
+            self.handle_sp_api_error(sp_api_method, e)
+
+    def retry_sp_api_method(self, sp_api_method, **kwargs):
+        """Returns the payload of sp_api_method, retried like `retry`."""
+        result = self.retry(sp_api_method, **kwargs)
+        # responses of the Reports API 2021-06-30 are not wrapped in a payload
+        return result.get("payload") if "payload" in result else result
+
+    def retry(self, method, **kwargs):
+        """Returns the result of method. Throttled and server errors are retried with
+        exponential backoff, the last error is raised once max retries are exceeded."""
+        max_retries = max(self.amz_setting.max_retry_limit or 0, 1)
+
+        for attempt in range(max_retries):
             try:
-                result = sp_api_method(**kwargs)
-                return result.get("payload")
-            except sp_api.SPAPIError as e:
-                if e.error not in errors:
-                    errors[e.error] = e.error_description
-                time.sleep(1)
-                continue
+                return method(**kwargs)
+            except sp_api.SPAPIRetryableError as e:
+                if attempt == max_retries - 1:
+                    raise
+                time.sleep(get_backoff(attempt, e.retry_after))
+
+    def handle_sp_api_error(self, sp_api_method, e):
+        msg = f"<b>Error:</b> {e.error}<br/><b>Error Description:</b> {e.error_description}"
+        frappe.msgprint(msg, alert=True, indicator="red")
+        frappe.log_error(
+            message=f"{e.error}: {e.error_description}",
+            title=f'Method "{sp_api_method.__name__}" failed',
+        )
 
-        for error in errors:
-            msg = f"<b>Error:</b> {error}<br/><b>Error Description:</b> {errors.get(error)}"
-            frappe.msgprint(msg, alert=True, indicator="red")
-            frappe.log_error(
-                message=f"{error}: {errors.get(error)}",
-                title=f'Method "{sp_api_method.__name__}" failed',
+        if isinstance(e, (sp_api.SPAPIRetryableError, sp_api.SPAPICircuitOpenError)):
+            # throttled or paused operation, it will be picked up by a later sync
+            frappe.throw(
+                _(
+                    "Amazon is throttling or unavailable for {0}. It will be retried in the next sync."
+                ).format(sp_api_method.__name__)
             )
 
+        # invalid request or credentials, retrying will not help
         self.amz_setting.enable_sync = 0
         self.amz_setting.save()
 
@@ -64,6 +89,20 @@ class AmazonRepository:
             )
         )
 
+    def paginate(self, sp_api_method, items, prefetch=False, **kwargs):
+        """Yields the items of every page of sp_api_method, retrying each page like
+        `call_sp_api_method`. With prefetch, the next page is fetched in the background."""
+
+        def fetch_page(next_token):
+            return self.retry_sp_api_method(
+                sp_api_method, next_token=next_token, **kwargs
+            )
+
+        try:
+            yield from sp_api.paginate(fetch_page, items, prefetch=prefetch)
+        except sp_api.SPAPIError as e:
+            self.handle_sp_api_error(sp_api_method, e)
+
     # Finances Section
     def get_finances_instance(self):
         return sp_api.Finances(**self.instance_params)
@@ -83,74 +122,57 @@ class AmazonRepository:
 
         return account_name
 
-    def get_charges_and_fees(self, order_id):
-        finances = self.get_finances_instance()
-        financial_events_payload = self.call_sp_api_method(
-            sp_api_method=finances.list_financial_events_by_order_id, order_id=order_id
-        )
+    def get_charges_and_fees(self, order_id, shipment_events=None):
+        if shipment_events is None:
+            finances = self.get_finances_instance()
+            shipment_events = self.paginate(
+                finances.list_financial_events_by_order_id,
+                get_shipment_events,
+                order_id=order_id,
+            )
 
         charges_and_fees = {"charges": [], "fees": []}
 
-        while True:
-
-            shipment_event_list = financial_events_payload.get(
-                "FinancialEvents", {}
-            ).get("ShipmentEventList", [])
-            next_token = financial_events_payload.get("NextToken")
+        for shipment_event in shipment_events:
 
-            for shipment_event in shipment_event_list:
+            if shipment_event:
 
-                if shipment_event:
+                for shipment_item in shipment_event.get("ShipmentItemList", []):
+                    charges = shipment_item.get("ItemChargeList", [])
+                    fees = shipment_item.get("ItemFeeList", [])
+                    seller_sku = shipment_item.get("SellerSKU")
 
-                    for shipment_item in shipment_event.get("ShipmentItemList", []):
-                        charges = shipment_item.get("ItemChargeList", [])
-                        fees = shipment_item.get("ItemFeeList", [])
-                        seller_sku = shipment_item.get("SellerSKU")
+                    for charge in charges:
 
-                        for charge in charges:
+                        charge_type = charge.get("ChargeType")
+                        amount = charge.get("ChargeAmount", {}).get("CurrencyAmount", 0)
 
-                            charge_type = charge.get("ChargeType")
-                            amount = charge.get("ChargeAmount", {}).get(
-                                "CurrencyAmount", 0
+                        if charge_type != "Principal" and float(amount) != 0:
+                            charge_account = self.get_account(charge_type)
+                            charges_and_fees.get("charges").append(
+                                {
+                                    "charge_type": "Actual",
+                                    "account_head": charge_account,
+                                    "tax_amount": amount,
+                                    "description": charge_type + " for " + seller_sku,
+                                }
                             )
 
-                            if charge_type != "Principal" and float(amount) != 0:
-                                charge_account = self.get_account(charge_type)
-                                charges_and_fees.get("charges").append(
-                                    {
-                                        "charge_type": "Actual",
-                                        "account_head": charge_account,
-                                        "tax_amount": amount,
-                                        "description": charge_type
-                                        + " for "
-                                        + seller_sku,
-                                    }
-                                )
-
-                        for fee in fees:
-
-                            fee_type = fee.get("FeeType")
-                            amount = fee.get("FeeAmount", {}).get("CurrencyAmount", 0)
-
-                            if float(amount) != 0:
-                                fee_account = self.get_account(fee_type)
-                                charges_and_fees.get("fees").append(
-                                    {
-                                        "charge_type": "Actual",
-                                        "account_head": fee_account,
-                                        "tax_amount": amount,
-                                        "description": fee_type + " for " + seller_sku,
-                                    }
-                                )
-
-            if not next_token:
-                break
-
-            financial_events_payload = self.call_sp_api_method(
-                sp_api_method=finances.list_financial_events_by_order_id,
-                order_id=order_id,
-                next_token=next_token,
-            )
+                    for fee in fees:
+
+                        fee_type = fee.get("FeeType")
+                        amount = fee.get("FeeAmount", {}).get("CurrencyAmount", 0)
+
+                        if float(amount) != 0:
+                            fee_account = self.get_account(fee_type)
+                            charges_and_fees.get("fees").append(
+                                {
+                                    "charge_type": "Actual",
+                                    "account_head": fee_account,
+                                    "tax_amount": amount,
+                                    "description": fee_type + " for " + seller_sku,
+                                }
+                            )
 
         return charges_and_fees
 
@@ -252,60 +274,99 @@ class AmazonRepository:
         else:
             raise KeyError("ASIN")
 
-    def get_order_items(self, order_id):
-        orders = self.get_orders_instance()
-        order_items_payload = self.call_sp_api_method(
-            sp_api_method=orders.get_order_items, order_id=order_id
-        )
+    def get_order_items(self, order_id, order_items=None):
+        if order_items is None:
+            orders = self.get_orders_instance()
+            order_items = self.paginate(
+                orders.get_order_items, "OrderItems", order_id=order_id
+            )
 
         final_order_items = []
         warehouse = self.amz_setting.warehouse
 
-        while True:
-
-            order_items_list = order_items_payload.get("OrderItems")
-            next_token = order_items_payload.get("NextToken")
-
-            for order_item in order_items_list:
-                price = order_item.get("ItemPrice", {}).get("Amount", 0)
-
-                final_order_items.append(
-                    {
-                        "item_code": self.get_item_code(order_item),
-                        "item_name": order_item.get("SellerSKU"),
-                        "description": order_item.get("Title"),
-                        "rate": price,
-                        "qty": order_item.get("QuantityOrdered"),
-                        "stock_uom": "Nos",
-                        "warehouse": warehouse,
-                        "conversion_factor": "1.0",
-                    }
+        for order_item in order_items:
+            price = order_item.get("ItemPrice", {}).get("Amount", 0)
+
+            final_order_items.append(
+                {
+                    "item_code": self.get_item_code(order_item),
+                    "item_name": order_item.get("SellerSKU"),
+                    "description": order_item.get("Title"),
+                    "rate": price,
+                    "qty": order_item.get("QuantityOrdered"),
+                    "stock_uom": "Nos",
+                    "warehouse": warehouse,
+                    "conversion_factor": "1.0",
+                }
+            )
+
+        return final_order_items
+
+    def get_order_details(self, order_ids):
+        """Fetches the order items and, if taxes and charges are synced, the shipment
+        events of all order_ids concurrently, within the rate limits of the operations.
+
+        Returns {order_id: {"order_items": [], "shipment_events": []}}. If fetching an
+        order failed, its "error" is set to the SPAPIError instead."""
+        orders = sp_api.AsyncSPAPI(self.get_orders_instance())
+        finances = sp_api.AsyncSPAPI(self.get_finances_instance())
+
+        def get_fetch_page(sp_api_method, order_id):
+            def fetch_page(next_token):
+                return self.retry_sp_api_method(
+                    sp_api_method, order_id=order_id, next_token=next_token
                 )
 
-            if not next_token:
-                break
+            return fetch_page
 
-            order_items_payload = self.call_sp_api_method(
-                sp_api_method=orders.get_order_items,
-                order_id=order_id,
-                next_token=next_token,
+        async def get_details(order_id):
+            details = {"order_items": None, "shipment_events": None}
+            try:
+                details["order_items"] = await orders.paginate(
+                    get_fetch_page(orders.client.get_order_items, order_id),
+                    "OrderItems",
+                )
+                if self.amz_setting.taxes_charges:
+                    details["shipment_events"] = await finances.paginate(
+                        get_fetch_page(
+                            finances.client.list_financial_events_by_order_id, order_id
+                        ),
+                        get_shipment_events,
+                    )
+            except sp_api.SPAPIError as e:
+                details["error"] = e
+            return details
+
+        async def get_all_details():
+            details = await asyncio.gather(
+                *(get_details(order_id) for order_id in order_ids)
             )
+            return dict(zip(order_ids, details))
 
-        return final_order_items
+        return asyncio.run(get_all_details())
 
-    def create_sales_order(self, order):
+    def create_sales_order(self, order, order_details=None, existing_sales_orders=None):
         customer_name = self.create_customer(order)
         self.create_address(order, customer_name)
 
         order_id = order.get("AmazonOrderId")
-        sales_order = frappe.db.get_value(
-            "Sales Order", filters={"amazon_order_id": order_id}, fieldname="name"
-        )
+        if existing_sales_orders is not None:
+            sales_order = existing_sales_orders.get(order_id)
+        else:
+            sales_order = frappe.db.get_value(
+                "Sales Order", filters={"amazon_order_id": order_id}, fieldname="name"
+            )
 
         if sales_order:
             return sales_order
         else:
-            items = self.get_order_items(order_id)
+            order_details = order_details or {}
+            if order_details.get("error"):
+                self.handle_sp_api_error(
+                    self.get_orders_instance().get_order_items, order_details["error"]
+                )
+
+            items = self.get_order_items(order_id, order_details.get("order_items"))
             delivery_date = dateutil.parser.parse(order.get("LatestShipDate")).strftime(
                 "%Y-%m-%d"
             )
@@ -330,7 +391,9 @@ class AmazonRepository:
             taxes_and_charges = self.amz_setting.taxes_charges
 
             if taxes_and_charges:
-                charges_and_fees = self.get_charges_and_fees(order_id)
+                charges_and_fees = self.get_charges_and_fees(
+                    order_id, order_details.get("shipment_events")
+                )
                 for charge in charges_and_fees.get("charges"):
                     sales_order.append("taxes", charge)
                 for fee in charges_and_fees.get("fees"):
@@ -354,8 +417,10 @@ class AmazonRepository:
         ]
         fulfillment_channels = ["FBA", "SellerFulfilled"]
 
-        orders_payload = self.call_sp_api_method(
-            sp_api_method=orders.get_orders,
+        orders_list = self.paginate(
+            orders.get_orders,
+            "Orders",
+            prefetch=True,
             created_after=created_after,
             order_statuses=order_statuses,
             fulfillment_channels=fulfillment_channels,
@@ -364,27 +429,29 @@ class AmazonRepository:
 
         sales_orders = []
 
-        while True:
-
-            orders_list = orders_payload.get("Orders")
-            next_token = orders_payload.get("NextToken")
-
-            if not orders_list or len(orders_list) == 0:
-                break
+        for orders_batch in iter_batches(orders_list, 50):
+            # fetch the items and charges of a page of new orders concurrently
+            existing_sales_orders = get_existing_values(
+                "Sales Order",
+                "amazon_order_id",
+                [order.get("AmazonOrderId") for order in orders_batch],
+            )
+            order_details = self.get_order_details(
+                [
+                    order.get("AmazonOrderId")
+                    for order in orders_batch
+                    if order.get("AmazonOrderId") not in existing_sales_orders
+                ]
+            )
 
-            for order in orders_list:
-                sales_order = self.create_sales_order(order)
+            for order in orders_batch:
+                sales_order = self.create_sales_order(
+                    order,
+                    order_details.get(order.get("AmazonOrderId")),
+                    existing_sales_orders,
+                )
                 sales_orders.append(sales_order)
 
-            if not next_token:
-                break
-
-            orders_payload = self.call_sp_api_method(
-                sp_api_method=orders.get_orders,
-                created_after=created_after,
-                next_token=next_token,
-            )
-
         return sales_orders
 
     # CatalogItems or Products Section
@@ -497,14 +564,14 @@ class AmazonRepository:
         if report_id:
             report_document = self.get_report_document(report_id)
 
-            if report_document:
+            if report_document is not None:
                 catalog_items = self.get_catalog_items_instance()
 
                 for item in report_document:
                     asin = item.get("asin1") or item.get("product-id")
                     sku = item.get("seller-sku")
-                    amazon_item = catalog_items.get_catalog_item(asin=asin).get(
-                        "payload"
+                    amazon_item = self.call_sp_api_method(
+                        catalog_items.get_catalog_item, asin=asin
                     )
                     item_name = self.create_item(amazon_item, asin, sku)
                     products.append(item_name)
@@ -522,7 +589,8 @@ class AmazonRepository:
         data_end_time=None,
     ):
         reports = self.get_reports_instance()
-        response = reports.create_report(
+        response = self.call_sp_api_method(
+            reports.create_report,
             report_type=report_type,
             data_start_time=data_start_time,
             data_end_time=data_end_time,
@@ -531,10 +599,13 @@ class AmazonRepository:
         return response.get("reportId")
 
     def get_report_document(self, report_id):
+        """Returns a generator of the rows of the report, as dicts keyed by column, or None
+        if the report is not ready or empty. The document is downloaded before returning,
+        so download errors are retried and handled like the API calls."""
         reports = self.get_reports_instance()
 
         for x in range(3):
-            response = reports.get_report(report_id)
+            response = self.call_sp_api_method(reports.get_report, report_id=report_id)
             processingStatus = response.get("processingStatus")
 
             if not processingStatus:
@@ -548,34 +619,40 @@ class AmazonRepository:
                 report_document_id = response.get("reportDocumentId")
 
                 if report_document_id:
-                    response = reports.get_report_document(report_document_id)
-                    url = response.get("url")
-
-                    if url:
-                        rows = []
+                    response = self.call_sp_api_method(
+                        reports.get_report_document,
+                        report_document_id=report_document_id,
+                    )
+                    document = self.download_report_document(response)
+                    if not document.read(1):
+                        document.close()
+                        return None
+                    document.seek(0)
+                    return sp_api.iter_report_rows(document)
+                raise (KeyError("reportDocumentId"))
 
-                        for line in urllib.request.urlopen(url):
-                            decoded_line = line.decode("utf-8").replace("\t", "\n")
-                            row = decoded_line.splitlines()
-                            rows.append(row)
+    def download_report_document(self, report_document):
+        try:
+            return self.retry(
+                sp_api.download_report_document, report_document=report_document
+            )
+        except sp_api.SPAPIError as e:
+            self.handle_sp_api_error(sp_api.download_report_document, e)
 
-                        fields = rows[0]
-                        rows.pop(0)
 
-                        data = []
+# Helper functions
+def get_shipment_events(financial_events_payload):
+    return financial_events_payload.get("FinancialEvents", {}).get(
+        "ShipmentEventList", []
+    )
 
-                        for row in rows:
-                            data_row = {}
-                            for index, value in enumerate(row):
-                                data_row[fields[index]] = value
-                            data.append(data_row)
 
-                        return data
-                    raise (KeyError("url"))
-                raise (KeyError("reportDocumentId"))
+def iter_batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 
-# Helper functions
 def validate_amazon_sp_api_credentials(**args):
     api = sp_api.SPAPI(
         iam_arn=args.get("iam_arn"),
@@ -589,7 +666,7 @@ def validate_amazon_sp_api_credentials(**args):
 
     try:
         # validate client_id, client_secret and refresh_token.
-        api.get_access_token()
+        api.fetch_access_token()
 
         # validate aws_access_key, aws_secret_key, region and iam_arn.
         api.get_auth()
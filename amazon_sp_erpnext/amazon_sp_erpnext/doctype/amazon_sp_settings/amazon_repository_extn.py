@@ -8,7 +8,9 @@ from frappe import _
 from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_repository import (
     AmazonRepository,
 )
-import json
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_order_log.amazon_order_log import (
+    AmazonOrderLogWriter,
+)
 import dateutil
 from frappe.utils import add_days, today
 from datetime import datetime
@@ -23,7 +25,8 @@ class AmazonRepositoryExtn(AmazonRepository):
 
     def _get_orders(self, created_after):
         """
-        Get Orders from Amazom SP SPI and create log entry for each order."""
+        Get Orders from Amazom SP SPI and create log entry for each order.
+        Orders are yielded page by page, while the next page is fetched in the background."""
 
         if not created_after:
             created_after = frappe.db.get_value(
@@ -48,41 +51,19 @@ class AmazonRepositoryExtn(AmazonRepository):
             "FBA",  # "SellerFulfilled"
         ]
 
-        orders_payload = self.call_sp_api_method(
-            sp_api_method=orders.get_orders,
+        orders_list = self.paginate(
+            orders.get_orders,
+            "Orders",
+            prefetch=True,
             created_after=created_after,
             order_statuses=order_statuses,
             fulfillment_channels=fulfillment_channels,
             max_results=50,
         )
 
-        amazon_orders = []
-
-        # frappe.log_error("Amazon SP API getOrders Response", orders_payload)
-        logger.debug(orders_payload)
-
-        while True:
-
-            orders_list = orders_payload.get("Orders")
-            next_token = orders_payload.get("NextToken")
-
-            if not orders_list or len(orders_list) == 0:
-                break
-
-            amazon_orders.extend(orders_list)
-
-            if not next_token:
-                break
-
-            orders_payload = self.call_sp_api_method(
-                sp_api_method=orders.get_orders,
-                created_after=created_after,
-                next_token=next_token,
-                max_results=50,
-            )
-            logger.debug(orders_payload)
-
-        return amazon_orders
+        for order in orders_list:
+            logger.debug(order)
+            yield order
 
     def get_item_code(self, order_item):
         item_code_key = self.amz_setting.amazon_item_field_in_erpnext or "ASIN"
@@ -94,53 +75,39 @@ class AmazonRepositoryExtn(AmazonRepository):
         else:
             raise KeyError(item_code_key)
 
-    def get_order_items(self, order_id):
-        orders = self.get_orders_instance()
-        order_items_payload = self.call_sp_api_method(
-            sp_api_method=orders.get_order_items, order_id=order_id
-        )
-        logger.debug(order_items_payload)
+    def get_order_items(self, order_id, order_items=None):
+        if order_items is None:
+            orders = self.get_orders_instance()
+            order_items = self.paginate(
+                orders.get_order_items, "OrderItems", order_id=order_id
+            )
 
         final_order_items = []
         warehouse = self.amz_setting.warehouse
 
-        while True:
-
-            order_items_list = order_items_payload.get("OrderItems")
-            next_token = order_items_payload.get("NextToken")
-
-            for order_item in order_items_list:
-                price = order_item.get("ItemPrice", {}).get("Amount", 0)
-
-                item_details = frappe.db.get_value(
-                    "Item",
-                    self.get_item_code(order_item),
-                    ["item_code", "item_name", "description"],
-                    as_dict=True,
-                )
-
-                final_order_items.append(
-                    {
-                        "item_code": item_details.item_code,
-                        "item_name": item_details.item_name,
-                        "description": item_details.description,
-                        "rate": price,
-                        "qty": order_item.get("QuantityOrdered"),
-                        "stock_uom": "Nos",
-                        "warehouse": warehouse,
-                        "conversion_factor": "1.0",
-                    }
-                )
-
-            if not next_token:
-                break
-
-            order_items_payload = self.call_sp_api_method(
-                sp_api_method=orders.get_order_items,
-                order_id=order_id,
-                next_token=next_token,
+        for order_item in order_items:
+            logger.debug(order_item)
+            price = order_item.get("ItemPrice", {}).get("Amount", 0)
+
+            item_details = frappe.db.get_value(
+                "Item",
+                self.get_item_code(order_item),
+                ["item_code", "item_name", "description"],
+                as_dict=True,
+            )
+
+            final_order_items.append(
+                {
+                    "item_code": item_details.item_code,
+                    "item_name": item_details.item_name,
+                    "description": item_details.description,
+                    "rate": price,
+                    "qty": order_item.get("QuantityOrdered"),
+                    "stock_uom": "Nos",
+                    "warehouse": warehouse,
+                    "conversion_factor": "1.0",
+                }
             )
-            logger.debug(order_items_payload)
 
         return final_order_items
 
@@ -154,11 +121,6 @@ def make_order_log(created_after=None):
 
     amz = AmazonRepositoryExtn("CARMEL ORGANICS PRIVATE LIMITED")
     orders = amz._get_orders(created_after)
-    for d in orders:
-        frappe.get_doc(
-            {
-                "doctype": "Amazon Order Log",
-                "amazon_order_id": d.get("AmazonOrderId"),
-                "amazon_order_json": json.dumps(d),
-            }
-        ).insert()
+    with AmazonOrderLogWriter() as log_writer:
+        for d in orders:
+            log_writer.append(d.get("AmazonOrderId"), d)
@@ -2,17 +2,43 @@
 # For license information, please see license.txt
 
 
+import asyncio
+import codecs
+import csv
 import datetime
+import email.utils
 import hashlib
 import hmac
+import os
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import lru_cache, partial
 
 import boto3
-from requests import request
+import frappe
+import redis
+from frappe.utils import cint
+from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
 from requests.compat import urlparse
+from requests.exceptions import RequestException
+
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_throttle import (
+    CircuitBreaker,
+    RateLimiter,
+)
 
 __all__ = [
+    "paginate",
+    "iter_report_rows",
+    "AsyncSPAPI",
     "SPAPIError",
+    "SPAPIRetryableError",
+    "SPAPICircuitOpenError",
     "Finances",
     "Orders",
     "CatalogItems",
@@ -56,6 +82,26 @@ MARKETPLACES = {
     },
 }
 
+# LWA access tokens are valid for an hour (`expires_in`). They are cached in redis, shared by
+# all workers, and refreshed this many seconds before Amazon expires them.
+LWA_TOKEN_CACHE_KEY = "amazon_sp_api:lwa_access_token:{}"
+LWA_TOKEN_EXPIRY_MARGIN = 120
+LWA_TOKEN_LOCK_TIMEOUT = 30
+
+# Temporary STS credentials are reused until this many seconds before their `Expiration`.
+STS_CREDENTIALS_EXPIRY_MARGIN = 300
+
+# Keep-alive HTTP sessions, one per endpoint. Pool size and timeouts (in seconds) can be
+# overridden with `amazon_sp_api_pool_size`, `amazon_sp_api_connect_timeout` and
+# `amazon_sp_api_read_timeout` in site_config.json.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+# Report documents are downloaded to a temporary file, kept in memory up to this size
+REPORT_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+REPORT_CHUNK_SIZE = 64 * 1024
+
 # Following code is adapted from https://github.com/andrewjroth/requests-auth-aws-sigv4 under the Apache License 2.0 with minor changes.
 
 # Copyright 2020 Andrew J Roth <andrew@andrewjroth.com>
@@ -69,6 +115,19 @@ MARKETPLACES = {
 # 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
 
 
+def sign(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=64)
+def get_signing_key(secret_access_key, datestamp, region, service):
+    """Derives the SigV4 signing key. It only changes with the date, so it is memoized."""
+    key_date = sign(("AWS4" + secret_access_key).encode("utf-8"), datestamp)
+    key_region = sign(key_date, region)
+    k_service = sign(key_region, service)
+    return sign(k_service, "aws4_request")
+
+
 class AWSSigV4(AuthBase):
     def __init__(self, service, **kwargs):
         """Create authentication mechanism
@@ -196,15 +255,9 @@ class AWSSigV4(AuthBase):
         )
 
         # ************* TASK 3: CALCULATE THE SIGNATURE *************
-        def sign(key, msg):
-            return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
-
-        key_date = sign(
-            ("AWS4" + self.aws_secret_access_key).encode("utf-8"), self.datestamp
+        key_signing = get_signing_key(
+            self.aws_secret_access_key, self.datestamp, self.region, self.service
         )
-        key_region = sign(key_date, self.region)
-        k_service = sign(key_region, self.service)
-        key_signing = sign(k_service, "aws4_request")
         signature = hmac.new(
             key_signing, string_to_sign.encode("utf-8"), hashlib.sha256
         ).hexdigest()
@@ -218,6 +271,95 @@ class AWSSigV4(AuthBase):
         return request
 
 
+class AssumeRoleCredentialProvider(object):
+    """Per process cache of STS clients and of the temporary credentials of assumed roles.
+
+    Credentials are reused until shortly before their `Expiration`, so `assume_role` is
+    called about once an hour per role instead of once per request. Each role has its
+    own lock, so a slow `assume_role` call does not hold up the other roles."""
+
+    clients = {}
+    credentials = {}
+    locks = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get_client(cls, aws_access_key, aws_secret_key, region):
+        key = (aws_access_key, Util.get_hash(aws_secret_key), region)
+        with cls.lock:
+            client = cls.clients.get(key)
+            if not client:
+                client = boto3.client(
+                    "sts",
+                    aws_access_key_id=aws_access_key,
+                    aws_secret_access_key=aws_secret_key,
+                    region_name=region,
+                )
+                cls.clients[key] = client
+            return client
+
+    @classmethod
+    def get_lock(cls, key) -> threading.Lock:
+        with cls.lock:
+            return cls.locks.setdefault(key, threading.Lock())
+
+    @classmethod
+    def get_credentials(cls, iam_arn, aws_access_key, aws_secret_key, region) -> dict:
+        key = (iam_arn, aws_access_key, Util.get_hash(aws_secret_key), region)
+
+        with cls.get_lock(key):
+            credentials = cls.credentials.get(key)
+            if credentials and not cls.is_expiring(credentials):
+                return credentials
+
+            client = cls.get_client(aws_access_key, aws_secret_key, region)
+            response = client.assume_role(
+                RoleArn=iam_arn, RoleSessionName="SellingPartnerAPI"
+            )
+            credentials = response["Credentials"]
+            cls.credentials[key] = credentials
+            return credentials
+
+    @staticmethod
+    def is_expiring(credentials) -> bool:
+        expiration = credentials.get("Expiration")
+        if not expiration:
+            return True
+        return expiration - datetime.datetime.now(
+            datetime.timezone.utc
+        ) < datetime.timedelta(seconds=STS_CREDENTIALS_EXPIRY_MARGIN)
+
+
+class SessionPool(object):
+    """Per process `requests.Session` for each endpoint, so that consecutive calls to the
+    same endpoint reuse the TCP and TLS connection instead of opening a new one."""
+
+    sessions = {}
+    lock = threading.Lock()
+    # transport adapter that replaces the network for all sessions, see amazon_sp_simulator
+    adapter = None
+
+    @classmethod
+    def get_session(cls, url) -> Session:
+        parsed_url = urlparse(url)
+        base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        # sessions must not be shared with forked worker processes
+        key = (os.getpid(), base_url)
+
+        with cls.lock:
+            session = cls.sessions.get(key)
+            if not session:
+                session = Session()
+                pool_size = Util.get_pool_size()
+                session.mount(
+                    base_url,
+                    cls.adapter
+                    or HTTPAdapter(pool_connections=1, pool_maxsize=pool_size),
+                )
+                cls.sessions[key] = session
+            return session
+
+
 class SPAPIError(Exception):
     """
     Main SP-API Exception class
@@ -226,9 +368,27 @@ class SPAPIError(Exception):
     def __init__(self, *args, **kwargs) -> None:
         self.error = kwargs.get("error", "-")
         self.error_description = kwargs.get("error_description", "-")
+        self.status_code = kwargs.get("status_code")
+        self.operation = kwargs.get("operation")
         super().__init__(*args)
 
 
+class SPAPIRetryableError(SPAPIError):
+    """
+    Throttled (HTTP 429), server (HTTP 5xx) and connection errors, that can succeed when retried
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.retry_after = kwargs.get("retry_after")
+        super().__init__(*args, **kwargs)
+
+
+class SPAPICircuitOpenError(SPAPIError):
+    """
+    Raised without calling the API while an operation is paused after repeated failures
+    """
+
+
 class SPAPI(object):
     """Base Amazon SP-API class"""
 
@@ -257,8 +417,11 @@ class SPAPI(object):
         self.region, self.endpoint, self.marketplace_id = Util.get_marketplace_data(
             country_code
         )
+        self.rate_limiter = RateLimiter(Util.get_hash(client_id, refresh_token))
+        self.circuit_breaker = CircuitBreaker(Util.get_hash(client_id, refresh_token))
 
-    def get_access_token(self) -> str:
+    def fetch_access_token(self) -> dict:
+        """Exchanges the refresh token for a new LWA access token, bypassing the cache."""
         data = {
             "grant_type": "refresh_token",
             "client_id": self.client_id,
@@ -266,29 +429,78 @@ class SPAPI(object):
             "refresh_token": self.refresh_token,
         }
 
-        response = request(method="POST", url=self.AUTH_URL, data=data)
-        result = response.json()
+        response = SessionPool.get_session(self.AUTH_URL).request(
+            method="POST", url=self.AUTH_URL, data=data, timeout=Util.get_timeout()
+        )
+        result = Util.get_json(response)
         if response.status_code == 200:
-            return result.get("access_token")
-        exception = SPAPIError(
-            error=result.get("error"), error_description=result.get("error_description")
+            return result
+
+        exception_class = (
+            SPAPIRetryableError if Util.is_retryable(response) else SPAPIError
+        )
+        exception = exception_class(
+            error=result.get("error"),
+            error_description=result.get("error_description"),
+            status_code=response.status_code,
+            retry_after=Util.get_retry_after(response),
         )
         raise exception
 
-    def get_auth(self) -> AWSSigV4:
+    def get_access_token(self) -> str:
+        """Returns the cached LWA access token for this client_id and refresh token.
+
+        When the token is missing or about to expire, only the worker holding the lock
+        fetches a new one. Other workers wait for it and reuse the refreshed token."""
+        cache = frappe.cache()
+        key = LWA_TOKEN_CACHE_KEY.format(
+            Util.get_hash(self.client_id, self.refresh_token)
+        )
+
+        access_token = cache.get_value(key, expires=True)
+        if access_token:
+            return access_token
+
+        lock = cache.lock(
+            cache.make_key(f"{key}:lock"),
+            timeout=LWA_TOKEN_LOCK_TIMEOUT,
+            blocking_timeout=LWA_TOKEN_LOCK_TIMEOUT,
+        )
+        # if the lock cannot be acquired in time, or redis is down, fetch a token anyway
         try:
-            client = boto3.client(
-                "sts",
-                aws_access_key_id=self.aws_access_key,
-                aws_secret_access_key=self.aws_secret_key,
-                region_name=self.region,
+            is_locked = lock.acquire()
+        except redis.exceptions.ConnectionError:
+            is_locked = False
+        try:
+            access_token = cache.get_value(key, expires=True)
+            if access_token:
+                return access_token
+
+            result = self.fetch_access_token()
+            access_token = result.get("access_token")
+            expires_in = cint(result.get("expires_in")) or 3600
+            cache.set_value(
+                key,
+                access_token,
+                expires_in_sec=max(expires_in - LWA_TOKEN_EXPIRY_MARGIN, 1),
             )
+            return access_token
+        finally:
+            if is_locked:
+                try:
+                    lock.release()
+                except (redis.exceptions.ConnectionError, redis.exceptions.LockError):
+                    pass
 
-            response = client.assume_role(
-                RoleArn=self.iam_arn, RoleSessionName="SellingPartnerAPI"
+    def get_auth(self) -> AWSSigV4:
+        try:
+            credentials = AssumeRoleCredentialProvider.get_credentials(
+                iam_arn=self.iam_arn,
+                aws_access_key=self.aws_access_key,
+                aws_secret_key=self.aws_secret_key,
+                region=self.region,
             )
 
-            credentials = response["Credentials"]
             access_key_id = credentials["AccessKeyId"]
             secret_access_key = credentials["SecretAccessKey"]
             session_token = credentials["SessionToken"]
@@ -301,7 +513,7 @@ class SPAPI(object):
                 region=self.region,
             )
         except Exception as e:
-            raise SPAPIError(error="invalid_aws_credentials", error_description=e)
+            raise SPAPIError(error="invalid_aws_credentials", error_description=str(e))
 
     def get_headers(self) -> dict:
         return {"x-amz-access-token": self.get_access_token()}
@@ -312,6 +524,7 @@ class SPAPI(object):
         append_to_base_uri: str = "",
         params: dict = None,
         data: dict = None,
+        operation: str = None,
     ) -> dict:
         if isinstance(params, dict):
             params = Util.remove_empty(params)
@@ -320,15 +533,55 @@ class SPAPI(object):
 
         url = self.endpoint + self.BASE_URI + append_to_base_uri
 
-        response = request(
-            method=method,
-            url=url,
-            params=params,
-            data=data,
-            headers=self.get_headers(),
-            auth=self.get_auth(),
+        if operation:
+            if self.circuit_breaker.is_open(operation):
+                raise SPAPICircuitOpenError(
+                    error="circuit_open",
+                    error_description=f"{operation} is paused after repeated failures.",
+                    operation=operation,
+                )
+            self.rate_limiter.acquire(operation)
+
+        try:
+            response = SessionPool.get_session(self.endpoint).request(
+                method=method,
+                url=url,
+                params=params,
+                data=data,
+                headers=self.get_headers(),
+                auth=self.get_auth(),
+                timeout=Util.get_timeout(),
+            )
+        except RequestException as e:
+            if operation:
+                self.circuit_breaker.record_failure(operation)
+            raise SPAPIRetryableError(
+                error="connection_error", error_description=str(e), operation=operation
+            )
+
+        if operation:
+            self.rate_limiter.learn(operation, response.headers)
+            if Util.is_retryable(response):
+                self.circuit_breaker.record_failure(operation)
+            else:
+                self.circuit_breaker.record_success(operation)
+
+        result = Util.get_json(response)
+        if response.ok:
+            return result
+
+        # https://developer-docs.amazon.com/sp-api/docs/response-format
+        error = (result.get("errors") or [{}])[0]
+        exception_class = (
+            SPAPIRetryableError if Util.is_retryable(response) else SPAPIError
+        )
+        raise exception_class(
+            error=error.get("code") or response.status_code,
+            error_description=error.get("message") or response.reason,
+            status_code=response.status_code,
+            retry_after=Util.get_retry_after(response),
+            operation=operation,
         )
-        return response.json()
 
     def list_to_dict(self, key: str, values: list, data: dict) -> None:
         if values and isinstance(values, list):
@@ -336,6 +589,166 @@ class SPAPI(object):
                 data[f"{key}[{idx}]"] = values[idx]
 
 
+def iter_pages(fetch_page, prefetch: bool = False):
+    """Yields the payload of each page of a paginated operation, following the NextToken.
+
+    :param fetch_page: callable that takes the `next_token` (None for the first page) and
+        returns the payload of that page.
+    :param prefetch: fetch the next page on a background thread while the caller
+        processes the current one.
+    """
+    if not prefetch:
+        next_token = None
+        while True:
+            payload = fetch_page(next_token) or {}
+            yield payload
+            next_token = Util.get_next_token(payload)
+            if not next_token:
+                return
+
+    # the fetch runs in a copy of the current context, so that frappe.local (conf,
+    # site and cache) is available to it on the background thread
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(copy_context().run, fetch_page, None)
+        while future:
+            payload = future.result() or {}
+            next_token = Util.get_next_token(payload)
+            future = next_token and executor.submit(
+                copy_context().run, fetch_page, next_token
+            )
+            yield payload
+
+
+def paginate(fetch_page, items, prefetch: bool = False):
+    """Lazily yields the items of all pages of a paginated operation.
+
+    :param items: key of the list of items in the payload, or a callable that returns
+        the items of a payload.
+    """
+    for payload in iter_pages(fetch_page, prefetch=prefetch):
+        if callable(items):
+            yield from items(payload) or []
+        else:
+            yield from payload.get(items) or []
+
+
+class AsyncSPAPI(object):
+    """asyncio variant of a SPAPI client, to fan out many calls concurrently.
+
+    Calls go through the wrapped client, so they share its signing, LWA token cache,
+    pooled sessions and rate limiter. Each call runs on a per process thread pool, sized
+    like the session pool, and is paced by the rate limiter of its operation.
+
+        finances = AsyncSPAPI(Finances(**params))
+        await finances.call(finances.client.list_financial_events_by_order_id, order_id=..)
+    """
+
+    executors = {}
+    lock = threading.Lock()
+
+    def __init__(self, client: SPAPI) -> None:
+        self.client = client
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        with cls.lock:
+            executor = cls.executors.get(os.getpid())
+            if not executor:
+                executor = ThreadPoolExecutor(max_workers=Util.get_pool_size())
+                cls.executors[os.getpid()] = executor
+            return executor
+
+    async def call(self, method, *args, **kwargs):
+        """Awaits `method(*args, **kwargs)` run on the thread pool, in a copy of the
+        current context so that frappe.local is available to it."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.get_executor(), partial(copy_context().run, method, *args, **kwargs)
+        )
+
+    async def paginate(self, fetch_page, items) -> list:
+        """Returns the items of all pages, like `paginate`, with each page awaited."""
+        result = []
+        next_token = None
+        while True:
+            payload = await self.call(fetch_page, next_token) or {}
+            result.extend(
+                (items(payload) if callable(items) else payload.get(items)) or []
+            )
+            next_token = Util.get_next_token(payload)
+            if not next_token:
+                return result
+
+
+def download_report_document(report_document: dict):
+    """Streams a report document to a spooled temporary file and returns it rewound.
+
+    :param report_document: response of getReportDocument, with the pre-signed `url` and
+        the `compressionAlgorithm`. GZIP documents are decompressed while downloading.
+
+    Failed and truncated downloads raise `SPAPIRetryableError`, like the API calls.
+    """
+    url = report_document.get("url")
+    if not url:
+        raise KeyError("url")
+
+    decompressor = None
+    if report_document.get("compressionAlgorithm") == "GZIP":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    document = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX_SIZE)
+    try:
+        with SessionPool.get_session(url).get(
+            url, stream=True, timeout=Util.get_timeout()
+        ) as response:
+            if not response.ok:
+                exception_class = (
+                    SPAPIRetryableError if Util.is_retryable(response) else SPAPIError
+                )
+                raise exception_class(
+                    error=response.status_code,
+                    error_description=response.reason,
+                    status_code=response.status_code,
+                    retry_after=Util.get_retry_after(response),
+                )
+            for chunk in response.iter_content(chunk_size=REPORT_CHUNK_SIZE):
+                document.write(
+                    decompressor.decompress(chunk) if decompressor else chunk
+                )
+        if decompressor:
+            document.write(decompressor.flush())
+    except RequestException as e:
+        document.close()
+        raise SPAPIRetryableError(error="connection_error", error_description=str(e))
+    except zlib.error as e:
+        document.close()
+        raise SPAPIRetryableError(
+            error="invalid_report_document", error_description=str(e)
+        )
+    except Exception:
+        document.close()
+        raise
+
+    document.seek(0)
+    return document
+
+
+def iter_report_rows(document, delimiter: str = "\t", encoding="utf-8"):
+    """Yields the rows of a TSV (or CSV) report document as dicts, keyed by its header.
+
+    The document, downloaded with `download_report_document`, is parsed line by line, so
+    memory use does not grow with the size of the report. It is closed at the end."""
+    with document:
+        lines = codecs.iterdecode(document, encoding)
+        if delimiter == "\t":
+            # flat file reports are tab separated without quoting
+            reader = csv.DictReader(lines, delimiter=delimiter, quoting=csv.QUOTE_NONE)
+        else:
+            reader = csv.DictReader(lines, delimiter=delimiter)
+
+        yield from reader
+
+
 class Finances(SPAPI):
     """Amazon Finances API"""
 
@@ -347,7 +760,11 @@ class Finances(SPAPI):
         """Returns all financial events for the specified order."""
         append_to_base_uri = f"orders/{order_id}/financialEvents"
         data = dict(MaxResultsPerPage=max_results, NextToken=next_token)
-        return self.make_request(append_to_base_uri=append_to_base_uri, params=data)
+        return self.make_request(
+            append_to_base_uri=append_to_base_uri,
+            params=data,
+            operation="listFinancialEventsByOrderId",
+        )
 
 
 class Orders(SPAPI):
@@ -401,13 +818,17 @@ class Orders(SPAPI):
             marketplace_ids = [self.marketplace_id]
             data["MarketplaceIds"] = marketplace_ids
 
-        return self.make_request(params=data)
+        return self.make_request(params=data, operation="getOrders")
 
     def get_order_items(self, order_id: str, next_token: str = None) -> dict:
         """Returns detailed order item information for the order indicated by the specified order ID. If NextToken is provided, it's used to retrieve the next page of order items."""
         append_to_base_uri = f"/{order_id}/orderItems"
         data = dict(NextToken=next_token)
-        return self.make_request(append_to_base_uri=append_to_base_uri, params=data)
+        return self.make_request(
+            append_to_base_uri=append_to_base_uri,
+            params=data,
+            operation="getOrderItems",
+        )
 
 
 class CatalogItems(SPAPI):
@@ -427,7 +848,11 @@ class CatalogItems(SPAPI):
         append_to_base_uri = f"/items/{asin}"
         data = dict(MarketplaceId=marketplace_id)
 
-        return self.make_request(append_to_base_uri=append_to_base_uri, params=data)
+        return self.make_request(
+            append_to_base_uri=append_to_base_uri,
+            params=data,
+            operation="getCatalogItem",
+        )
 
 
 class Reports(SPAPI):
@@ -459,18 +884,25 @@ class Reports(SPAPI):
             data["marketplaceIds"] = marketplace_ids
 
         return self.make_request(
-            method="POST", append_to_base_uri=append_to_base_uri, data=data
+            method="POST",
+            append_to_base_uri=append_to_base_uri,
+            data=data,
+            operation="createReport",
         )
 
     def get_report(self, report_id: str) -> dict:
         """Returns report details (including the reportDocumentId, if available) for the report that you specify."""
         append_to_base_uri = f"/reports/{report_id}"
-        return self.make_request(append_to_base_uri=append_to_base_uri)
+        return self.make_request(
+            append_to_base_uri=append_to_base_uri, operation="getReport"
+        )
 
     def get_report_document(self, report_document_id: str) -> dict:
         """Returns the information required for retrieving a report document's contents."""
         append_to_base_uri = f"/documents/{report_document_id}"
-        return self.make_request(append_to_base_uri=append_to_base_uri)
+        return self.make_request(
+            append_to_base_uri=append_to_base_uri, operation="getReportDocument"
+        )
 
 
 class Util:
@@ -492,6 +924,57 @@ class Util:
 
         return region, endpoint, marketplace_id
 
+    @staticmethod
+    def get_pool_size():
+        return cint(frappe.conf.get("amazon_sp_api_pool_size")) or DEFAULT_POOL_SIZE
+
+    @staticmethod
+    def get_timeout():
+        return (
+            cint(frappe.conf.get("amazon_sp_api_connect_timeout"))
+            or DEFAULT_CONNECT_TIMEOUT,
+            cint(frappe.conf.get("amazon_sp_api_read_timeout")) or DEFAULT_READ_TIMEOUT,
+        )
+
+    @staticmethod
+    def get_next_token(payload):
+        # Orders and Finances v0 use NextToken, newer APIs use nextToken
+        return payload.get("NextToken") or payload.get("nextToken")
+
+    @staticmethod
+    def get_json(response) -> dict:
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def is_retryable(response) -> bool:
+        return response.status_code == 429 or response.status_code >= 500
+
+    @staticmethod
+    def get_retry_after(response):
+        """Returns the Retry-After header in seconds. It is either seconds or a HTTP date."""
+        retry_after = response.headers.get("Retry-After")
+        if not retry_after:
+            return None
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if not retry_at.tzinfo:
+            retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+        return max(
+            (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0
+        )
+
+    @staticmethod
+    def get_hash(*args):
+        """Returns a digest of the arguments, used to key caches without exposing secrets."""
+        return hashlib.sha256(":".join(args).encode("utf-8")).hexdigest()
+
     @staticmethod
     def remove_empty(dict):
         """
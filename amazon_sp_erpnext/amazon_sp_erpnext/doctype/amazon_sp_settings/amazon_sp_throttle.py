@@ -0,0 +1,161 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+
+import random
+import time
+
+import frappe
+import redis
+from frappe.utils import flt
+
+# https://developer-docs.amazon.com/sp-api/docs/usage-plans-and-rate-limits-in-the-sp-api
+# Default (rate per second, burst) of each operation. The rate is replaced by the value
+# Amazon reports in the `x-amzn-RateLimit-Limit` response header, once one is seen.
+RATE_LIMITS = {
+    "getOrders": (0.0167, 20),
+    "getOrderItems": (0.5, 30),
+    "listFinancialEventsByOrderId": (0.5, 30),
+    "getCatalogItem": (2, 20),
+    "createReport": (0.0167, 15),
+    "getReports": (0.0222, 10),
+    "getReport": (2, 15),
+    "getReportDocument": (0.0167, 15),
+}
+DEFAULT_RATE_LIMIT = (1, 5)
+
+RATE_LIMIT_HEADER = "x-amzn-RateLimit-Limit"
+# learnt rates are forgotten after a day, in case Amazon changes the usage plan
+LEARNT_RATE_EXPIRY = 24 * 60 * 60
+
+# Exponential backoff with full jitter between retries of a failed call, in seconds
+BACKOFF_BASE = 2
+BACKOFF_CAP = 120
+
+# An operation is paused for CIRCUIT_COOLDOWN seconds after this many consecutive
+# throttled or failed calls, instead of turning off the sync of the whole account
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 15 * 60
+
+# Reserves a token from the bucket and returns how long the caller must wait for it.
+# Tokens may go negative, so that concurrent callers queue up behind each other
+# instead of all retrying at the same moment.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(redis.call('GET', KEYS[2])) or tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - 1
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 60)
+
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class RateLimiter(object):
+    """Token bucket per seller account and SP-API operation.
+
+    Bucket state lives in redis, so all workers using the same seller account pace
+    themselves together."""
+
+    script = None
+
+    def __init__(self, account) -> None:
+        self.account = account
+
+    def get_key(self, operation, suffix):
+        return frappe.cache().make_key(
+            f"amazon_sp_api:rate_limit:{self.account}:{operation}:{suffix}"
+        )
+
+    def get_script(self):
+        if not RateLimiter.script:
+            RateLimiter.script = frappe.cache().register_script(TOKEN_BUCKET_SCRIPT)
+        return RateLimiter.script
+
+    def reserve(self, operation) -> float:
+        """Takes a token for the operation, returning the seconds to wait to use it."""
+        rate, burst = RATE_LIMITS.get(operation, DEFAULT_RATE_LIMIT)
+        try:
+            wait = self.get_script()(
+                keys=[
+                    self.get_key(operation, "bucket"),
+                    self.get_key(operation, "rate"),
+                ],
+                args=[rate, burst, time.time()],
+            )
+        except redis.exceptions.ConnectionError:
+            return 0
+        return flt(wait)
+
+    def acquire(self, operation) -> None:
+        wait = self.reserve(operation)
+        if wait > 0:
+            time.sleep(wait)
+
+    def learn(self, operation, headers) -> None:
+        """Remembers the rate of the operation, from the headers of its response."""
+        rate = flt(headers.get(RATE_LIMIT_HEADER))
+        if rate <= 0:
+            return
+        try:
+            frappe.cache().set(
+                self.get_key(operation, "rate"), rate, ex=LEARNT_RATE_EXPIRY
+            )
+        except redis.exceptions.ConnectionError:
+            pass
+
+
+class CircuitBreaker(object):
+    """Pauses a single SP-API operation of a seller account after repeated failures.
+
+    The consecutive failure count and the open circuit are kept in redis, so a paused
+    operation is skipped by all workers until the cool-down period is over."""
+
+    def __init__(self, account) -> None:
+        self.account = account
+
+    def get_key(self, operation, suffix):
+        return frappe.cache().make_key(
+            f"amazon_sp_api:circuit:{self.account}:{operation}:{suffix}"
+        )
+
+    def is_open(self, operation) -> bool:
+        try:
+            # the key is already made, RedisWrapper.exists would prefix it again
+            return frappe.cache().get(self.get_key(operation, "open")) is not None
+        except redis.exceptions.ConnectionError:
+            return False
+
+    def record_failure(self, operation) -> None:
+        try:
+            cache = frappe.cache()
+            failures_key = self.get_key(operation, "failures")
+            failures = cache.incr(failures_key)
+            cache.expire(failures_key, CIRCUIT_COOLDOWN)
+
+            if failures >= CIRCUIT_FAILURE_THRESHOLD:
+                cache.set(self.get_key(operation, "open"), 1, ex=CIRCUIT_COOLDOWN)
+                cache.delete(failures_key)
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def record_success(self, operation) -> None:
+        try:
+            frappe.cache().delete(self.get_key(operation, "failures"))
+        except redis.exceptions.ConnectionError:
+            pass
+
+
+def get_backoff(attempt, retry_after=None) -> float:
+    """Returns the seconds to wait before the next retry, honoring Amazon's Retry-After."""
+    backoff = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+    return max(backoff, flt(retry_after))
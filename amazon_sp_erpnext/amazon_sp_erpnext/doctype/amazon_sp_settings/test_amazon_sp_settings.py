@@ -1,9 +1,115 @@
 # Copyright (c) 2022, Greycube and Contributors
 # See license.txt
 
+from unittest.mock import patch
+
 import frappe
 from frappe.tests.utils import FrappeTestCase
 
+import amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_api as sp_api
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_repository_extn import (
+    AmazonRepositoryExtn,
+)
+from amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_throttle import (
+    CIRCUIT_FAILURE_THRESHOLD,
+)
+from amazon_sp_erpnext.tests.amazon_sp_simulator import SPAPISimulator, simulate
+
+TEST_COMPANY = "_Test Amazon Company"
+CREATED_AFTER = "2022-11-01T00:00:00"
+ORDERS_PATH = "/orders/v0/orders"
+GET_BACKOFF = "amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_repository.get_backoff"
+
+
+def make_amazon_sp_settings():
+    if frappe.db.exists("Amazon SP Settings", TEST_COMPANY):
+        return frappe.get_doc("Amazon SP Settings", TEST_COMPANY)
+
+    # inactive, so that the credentials are not validated against Amazon
+    return frappe.get_doc(
+        {
+            "doctype": "Amazon SP Settings",
+            "company": TEST_COMPANY,
+            "is_active": 0,
+            "iam_arn": "arn:aws:iam::123456789012:role/sp-api-simulator",
+            "client_id": "amzn1.application-oa2-client.sp-api-simulator",
+            "client_secret": "sp-api-simulator-secret",
+            "refresh_token": "Atzr|sp-api-simulator",
+            "aws_access_key": "AKIASIMULATOR",
+            "aws_secret_key": "sp-api-simulator-secret-key",
+            "country": "IN",
+            "max_retry_limit": 3,
+        }
+    ).insert(ignore_permissions=True, ignore_links=True, ignore_mandatory=True)
+
 
 class TestAmazonSPSettings(FrappeTestCase):
-    pass
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.amz_setting = make_amazon_sp_settings()
+
+    def get_repository(self):
+        repository = AmazonRepositoryExtn(self.amz_setting.name)
+        # fresh LWA token, rate limit and circuit breaker cache keys for each test
+        repository.instance_params.update(
+            client_id=f"sp-api-simulator-{frappe.generate_hash(length=8)}"
+        )
+        return repository
+
+    def test_order_sync_pagination(self):
+        simulator = SPAPISimulator(order_count=23, page_size=5)
+        with simulate(simulator):
+            orders = list(self.get_repository()._get_orders(CREATED_AFTER))
+
+        order_ids = [d["AmazonOrderId"] for d in orders]
+        self.assertEqual(len(order_ids), 23)
+        self.assertEqual(len(set(order_ids)), 23)
+        self.assertEqual(simulator.calls[ORDERS_PATH], 5)
+
+    def test_throttled_calls_are_retried(self):
+        simulator = SPAPISimulator(order_count=3, throttle_calls=2)
+        with simulate(simulator), patch(GET_BACKOFF, return_value=0):
+            orders = list(self.get_repository()._get_orders(CREATED_AFTER))
+
+        self.assertEqual(len(orders), 3)
+        self.assertEqual(simulator.calls[ORDERS_PATH], 3)
+
+    def test_throttled_calls_open_circuit(self):
+        simulator = SPAPISimulator(throttle_calls=10)
+        repository = self.get_repository()
+
+        with simulate(simulator), patch(GET_BACKOFF, return_value=0):
+            orders = repository.get_orders_instance()
+
+            with self.assertRaises(sp_api.SPAPIRetryableError):
+                repository.retry_sp_api_method(
+                    orders.get_orders, created_after=CREATED_AFTER
+                )
+            self.assertEqual(
+                simulator.calls[ORDERS_PATH], self.amz_setting.max_retry_limit
+            )
+
+            # the operation is paused once the failures reach the threshold
+            with self.assertRaises(sp_api.SPAPICircuitOpenError):
+                repository.retry_sp_api_method(
+                    orders.get_orders, created_after=CREATED_AFTER
+                )
+            self.assertEqual(simulator.calls[ORDERS_PATH], CIRCUIT_FAILURE_THRESHOLD)
+
+    def test_report_calls_are_retried(self):
+        simulator = SPAPISimulator(throttle_calls=1)
+        with simulate(simulator), patch(GET_BACKOFF, return_value=0):
+            report_id = self.get_repository().create_report()
+
+        self.assertTrue(report_id)
+        self.assertEqual(simulator.calls["/reports/2021-06-30/reports"], 2)
+
+    def test_report_document_download(self):
+        simulator = SPAPISimulator(report_rows=3, compress_reports=True)
+        with simulate(simulator):
+            repository = self.get_repository()
+            rows = list(repository.get_report_document(repository.create_report()))
+
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]["seller-sku"], simulator.item_codes[0])
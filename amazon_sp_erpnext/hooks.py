@@ -122,7 +122,10 @@ scheduler_events = {
         "0 6-22/3 * * *": [
             "amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_on_demand_report.amazon_on_demand_report.create_amazon_reports_scheduled"
         ],
-    }
+    },
+    "hourly": [
+        "amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_on_demand_report.amazon_on_demand_report.resume_mtr_shards_scheduled"
+    ],
     # 	"daily": [
     # 		"amazon_sp_erpnext.tasks.daily"
     # 	],
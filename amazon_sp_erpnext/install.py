@@ -15,6 +15,7 @@ def after_migrate(**args):
                 label="Amazon Order Id",
                 insert_after="party_name",
                 allow_on_submit=1,
+                search_index=1,
             ),
         ],
         "Warehouse": [
@@ -54,4 +55,12 @@ def after_migrate(**args):
         print([x["label"] for x in custom_fields[d]])
 
     create_custom_fields(custom_fields)
+    add_amazon_order_id_index()
     frappe.db.commit()  # to avoid implicit-commit errors
+
+
+def add_amazon_order_id_index():
+    # duplicate checks look up orders by amazon order id. The field is created by
+    # ecommerce_integrations; amazon_order_id_cf of Sales Invoice has search_index.
+    if frappe.db.has_column("Sales Order", "amazon_order_id"):
+        frappe.db.add_index("Sales Order", ["amazon_order_id"])
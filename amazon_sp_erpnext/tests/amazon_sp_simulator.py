@@ -0,0 +1,491 @@
+# Copyright (c) 2022, Greycube and contributors
+# For license information, please see license.txt
+
+"""Offline stand-in for the LWA and SP-API endpoints.
+
+`SPAPISimulator` is a `requests` transport adapter that implements the endpoints used by
+this app: the LWA token, getOrders and getOrderItems with pagination, financial events,
+catalog items and the Reports create / get / document flow. Latency, throttling (HTTP 429)
+and page sizes are configurable.
+
+`RecordingAdapter` records the responses of the real endpoints to a fixture file and
+`ReplayAdapter` plays them back. Mount any of them with `simulate`:
+
+    with simulate(SPAPISimulator(order_count=1000, latency=0.1)):
+        AmazonRepository(amz_setting_name).get_orders(created_after)
+"""
+
+import base64
+import gzip
+import http.client
+import io
+import json
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from unittest.mock import patch
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from requests import Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import amazon_sp_erpnext.amazon_sp_erpnext.doctype.amazon_sp_settings.amazon_sp_api as sp_api
+
+REPORT_DOCUMENT_URL = "https://sp-api-simulator.local/report-documents/{}"
+
+SIMULATED_CREDENTIALS = {
+    "AccessKeyId": "ASIASIMULATOR",
+    "SecretAccessKey": "simulator-secret-access-key",
+    "SessionToken": "simulator-session-token",
+}
+
+
+def make_response(request, status_code, content=b"", headers=None):
+    if isinstance(content, (dict, list)):
+        content = json.dumps(content).encode("utf-8")
+        headers = dict(headers or {}, **{"Content-Type": "application/json"})
+
+    response = Response()
+    response.status_code = status_code
+    response.reason = http.client.responses.get(status_code, "")
+    response.headers = CaseInsensitiveDict(headers or {})
+    response.encoding = "utf-8"
+    # served from `raw`, so that streamed downloads work like real responses
+    response.raw = io.BytesIO(content)
+    response.url = request.url
+    response.request = request
+    return response
+
+
+class SPAPISimulator(BaseAdapter):
+    """Simulated LWA and SP-API endpoints, with generated data.
+
+    :param order_count: number of orders returned by getOrders.
+    :param items_per_order: number of order items of each order.
+    :param page_size: page size of getOrders, overrides MaxResultsPerPage when set.
+    :param items_page_size: page size of getOrderItems.
+    :param item_codes: ASIN / SKU values of the order items, e.g. existing Item codes.
+    :param latency: seconds each call takes.
+    :param throttle_rate: probability that a SP-API call is throttled with HTTP 429.
+    :param throttle_calls: number of first SP-API calls that are throttled.
+    :param rate_limit: value of the x-amzn-RateLimit-Limit header.
+    :param report_rows: number of rows of report documents.
+    :param report_polls: number of getReport calls before a report is DONE.
+    :param compress_reports: serve report documents gzip compressed.
+    """
+
+    def __init__(
+        self,
+        order_count=500,
+        items_per_order=2,
+        page_size=None,
+        items_page_size=100,
+        item_codes=None,
+        latency=0,
+        throttle_rate=0,
+        throttle_calls=0,
+        rate_limit=100,
+        report_rows=1000,
+        report_polls=0,
+        compress_reports=False,
+        seed=0,
+    ) -> None:
+        super().__init__()
+        self.order_count = order_count
+        self.items_per_order = items_per_order
+        self.page_size = page_size
+        self.items_page_size = items_page_size
+        self.item_codes = item_codes or [f"B0SIMULATED{i:03}" for i in range(100)]
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttle_calls = throttle_calls
+        self.rate_limit = rate_limit
+        self.report_rows = report_rows
+        self.report_polls = report_polls
+        self.compress_reports = compress_reports
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reports = {}
+        self.calls = defaultdict(int)
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlparse(request.url)
+        path = url.path
+        params = dict(parse_qsl(url.query))
+
+        if request.url.startswith(sp_api.SPAPI.AUTH_URL):
+            return self.get_access_token(request)
+
+        if url.netloc == urlparse(REPORT_DOCUMENT_URL).netloc:
+            return self.get_report_document_content(request, path.rsplit("/", 1)[-1])
+
+        with self.lock:
+            self.calls[path] += 1
+            throttled = (
+                sum(self.calls.values()) <= self.throttle_calls
+                or self.random.random() < self.throttle_rate
+            )
+
+        if throttled:
+            return make_response(
+                request,
+                429,
+                {
+                    "errors": [
+                        {"code": "QuotaExceeded", "message": "You exceeded your quota"}
+                    ]
+                },
+                headers={
+                    "Retry-After": "1",
+                    "x-amzn-RateLimit-Limit": str(self.rate_limit),
+                },
+            )
+
+        segments = path.strip("/").split("/")
+        if path == "/orders/v0/orders":
+            payload = self.get_orders(params)
+        elif path.startswith("/orders/v0/orders/") and segments[-1] == "orderItems":
+            payload = self.get_order_items(segments[-2], params)
+        elif path.startswith("/finances/v0/orders/"):
+            payload = self.get_financial_events(segments[-2])
+        elif path.startswith("/catalog/v0/items/"):
+            payload = self.get_catalog_item(segments[-1])
+        elif path == "/reports/2021-06-30/reports" and request.method == "POST":
+            payload = self.create_report()
+        elif path.startswith("/reports/2021-06-30/reports/"):
+            payload = self.get_report(segments[-1])
+        elif path.startswith("/reports/2021-06-30/documents/"):
+            payload = self.get_report_document(segments[-1])
+        else:
+            return make_response(
+                request,
+                404,
+                {
+                    "errors": [
+                        {"code": "NotFound", "message": f"{path} is not simulated"}
+                    ]
+                },
+            )
+
+        return make_response(
+            request,
+            200,
+            payload,
+            headers={"x-amzn-RateLimit-Limit": str(self.rate_limit)},
+        )
+
+    def close(self):
+        pass
+
+    def get_access_token(self, request):
+        return make_response(
+            request,
+            200,
+            {
+                "access_token": "Atza|simulated-access-token",
+                "refresh_token": "Atzr|simulated-refresh-token",
+                "token_type": "bearer",
+                "expires_in": 3600,
+            },
+        )
+
+    def get_item_code(self, order_id, idx):
+        return self.item_codes[
+            (zlib.crc32(order_id.encode()) + idx) % len(self.item_codes)
+        ]
+
+    def get_order_id(self, idx):
+        return f"171-{idx:07}-{idx * 7 % 10000000:07}"
+
+    def get_orders(self, params):
+        offset = int(params.get("NextToken") or 0)
+        page_size = self.page_size or int(params.get("MaxResultsPerPage") or 100)
+        end = min(offset + page_size, self.order_count)
+
+        orders = [
+            {
+                "AmazonOrderId": self.get_order_id(idx),
+                "PurchaseDate": "2022-11-01T10:15:00Z",
+                "LatestShipDate": "2022-11-03T18:29:59Z",
+                "OrderStatus": "Shipped",
+                "FulfillmentChannel": "AFN",
+                "MarketplaceId": "A21TJRUUN4KGV",
+                "BuyerInfo": {"BuyerName": f"Simulated Buyer {idx % 50}"},
+                "ShippingAddress": {
+                    "AddressLine1": f"{idx} Simulated Street",
+                    "City": "Bengaluru",
+                    "StateOrRegion": "KARNATAKA",
+                    "PostalCode": "560001",
+                    "CountryCode": "IN",
+                },
+            }
+            for idx in range(offset, end)
+        ]
+
+        payload = {"Orders": orders, "CreatedBefore": "2022-11-30T00:00:00Z"}
+        if end < self.order_count:
+            payload["NextToken"] = str(end)
+        return {"payload": payload}
+
+    def get_order_items(self, order_id, params):
+        offset = int(params.get("NextToken") or 0)
+        end = min(offset + self.items_page_size, self.items_per_order)
+
+        order_items = []
+        for idx in range(offset, end):
+            item_code = self.get_item_code(order_id, idx)
+            order_items.append(
+                {
+                    "ASIN": item_code,
+                    "SellerSKU": item_code,
+                    "OrderItemId": f"{order_id}-{idx}",
+                    "Title": f"Simulated item {item_code}",
+                    "QuantityOrdered": 1 + idx % 3,
+                    "ItemPrice": {"CurrencyCode": "INR", "Amount": "499.00"},
+                }
+            )
+
+        payload = {"AmazonOrderId": order_id, "OrderItems": order_items}
+        if end < self.items_per_order:
+            payload["NextToken"] = str(end)
+        return {"payload": payload}
+
+    def get_financial_events(self, order_id):
+        shipment_items = [
+            {
+                "SellerSKU": self.get_item_code(order_id, idx),
+                "ItemChargeList": [
+                    {
+                        "ChargeType": "Principal",
+                        "ChargeAmount": {
+                            "CurrencyCode": "INR",
+                            "CurrencyAmount": 499.0,
+                        },
+                    },
+                    {
+                        "ChargeType": "ShippingCharge",
+                        "ChargeAmount": {"CurrencyCode": "INR", "CurrencyAmount": 40.0},
+                    },
+                ],
+                "ItemFeeList": [
+                    {
+                        "FeeType": "FBAPerUnitFulfillmentFee",
+                        "FeeAmount": {"CurrencyCode": "INR", "CurrencyAmount": -28.0},
+                    }
+                ],
+            }
+            for idx in range(self.items_per_order)
+        ]
+
+        return {
+            "payload": {
+                "FinancialEvents": {
+                    "ShipmentEventList": [
+                        {
+                            "AmazonOrderId": order_id,
+                            "PostedDate": "2022-11-03T18:29:59Z",
+                            "ShipmentItemList": shipment_items,
+                        }
+                    ]
+                }
+            }
+        }
+
+    def get_catalog_item(self, asin):
+        return {
+            "payload": {
+                "Identifiers": {
+                    "MarketplaceASIN": {"MarketplaceId": "A21TJRUUN4KGV", "ASIN": asin}
+                },
+                "AttributeSets": [
+                    {
+                        "Title": f"Simulated item {asin}",
+                        "ProductGroup": "Simulated Products",
+                        "Brand": "Simulated Brand",
+                        "Manufacturer": "Simulated Manufacturer",
+                        "ListPrice": {"Amount": 499.0, "CurrencyCode": "INR"},
+                        "SmallImage": {"URL": ""},
+                    }
+                ],
+            }
+        }
+
+    def create_report(self):
+        with self.lock:
+            report_id = str(100000 + len(self.reports))
+            self.reports[report_id] = 0
+        return {"reportId": report_id}
+
+    def get_report(self, report_id):
+        with self.lock:
+            polls = self.reports.get(report_id, self.report_polls)
+            self.reports[report_id] = polls + 1
+
+        if polls < self.report_polls:
+            return {"reportId": report_id, "processingStatus": "IN_PROGRESS"}
+        return {
+            "reportId": report_id,
+            "processingStatus": "DONE",
+            "reportDocumentId": f"amzn1.spdoc.1.4.na.{report_id}",
+        }
+
+    def get_report_document(self, report_document_id):
+        document = {
+            "reportDocumentId": report_document_id,
+            "url": REPORT_DOCUMENT_URL.format(report_document_id),
+        }
+        if self.compress_reports:
+            document["compressionAlgorithm"] = "GZIP"
+        return document
+
+    def get_report_document_content(self, request, report_document_id):
+        fields = ["item-name", "seller-sku", "price", "quantity", "asin1", "product-id"]
+        lines = ["\t".join(fields)]
+        for idx in range(self.report_rows):
+            item_code = self.item_codes[idx % len(self.item_codes)]
+            lines.append(
+                "\t".join(
+                    [
+                        f"Simulated item {item_code}",
+                        item_code,
+                        "499.00",
+                        "10",
+                        item_code,
+                        item_code,
+                    ]
+                )
+            )
+
+        content = ("\n".join(lines) + "\n").encode("utf-8")
+        if self.compress_reports:
+            content = gzip.compress(content)
+        return make_response(request, 200, content)
+
+
+def get_fixture_key(method, url):
+    url = urlparse(url)
+    query = urlencode(sorted(parse_qsl(url.query)))
+    return f"{method} {url.netloc}{url.path}?{query}"
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Calls the real endpoints and appends each response to a fixture file (JSON lines).
+    Access tokens in LWA responses are redacted."""
+
+    def __init__(self, fixture_path, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fixture_path = fixture_path
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        content = response.content
+
+        if request.url.startswith(sp_api.SPAPI.AUTH_URL):
+            token = json.loads(content or "{}")
+            token.update(access_token="Atza|redacted", refresh_token="Atzr|redacted")
+            content = json.dumps(token).encode("utf-8")
+
+        fixture = {
+            "key": get_fixture_key(request.method, request.url),
+            "status_code": response.status_code,
+            "headers": dict(response.headers),
+            "body": base64.b64encode(content).decode("ascii"),
+        }
+        with self.lock, open(self.fixture_path, "a") as f:
+            f.write(json.dumps(fixture) + "\n")
+
+        # the body has been read, serve it again to the caller
+        response.raw = io.BytesIO(response.content)
+        response._content = False
+        response._content_consumed = False
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Serves the responses recorded by `RecordingAdapter`.
+
+    Responses are matched on method, host, path and query. Several responses recorded for
+    the same request are served in order, the last one is repeated after that."""
+
+    def __init__(self, fixture_path, latency=0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.fixtures = defaultdict(deque)
+
+        with open(fixture_path) as f:
+            for line in f:
+                if line.strip():
+                    fixture = json.loads(line)
+                    self.fixtures[fixture["key"]].append(fixture)
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        if self.latency:
+            time.sleep(self.latency)
+
+        key = get_fixture_key(request.method, request.url)
+        with self.lock:
+            fixtures = self.fixtures.get(key)
+            if not fixtures:
+                return make_response(
+                    request,
+                    404,
+                    {
+                        "errors": [
+                            {"code": "NotFound", "message": f"No recording for {key}"}
+                        ]
+                    },
+                )
+            fixture = fixtures.popleft() if len(fixtures) > 1 else fixtures[0]
+
+        headers = {
+            k: v
+            for k, v in fixture["headers"].items()
+            if k.lower()
+            not in ("content-encoding", "transfer-encoding", "content-length")
+        }
+        return make_response(
+            request,
+            fixture["status_code"],
+            base64.b64decode(fixture["body"]),
+            headers=headers,
+        )
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def simulate(adapter):
+    """Routes all SP-API, LWA and report document calls through `adapter`.
+
+    Unless the adapter records real calls, STS assume_role is skipped as well and requests
+    are signed with static credentials."""
+    sp_api.SessionPool.sessions.clear()
+    sp_api.SessionPool.adapter = adapter
+
+    try:
+        if isinstance(adapter, RecordingAdapter):
+            yield adapter
+        else:
+            with patch.object(
+                sp_api.AssumeRoleCredentialProvider,
+                "get_credentials",
+                return_value=SIMULATED_CREDENTIALS,
+            ):
+                yield adapter
+    finally:
+        sp_api.SessionPool.adapter = None
+        sp_api.SessionPool.sessions.clear()